@@ -1,26 +1,334 @@
 import os
 import sys
+import csv
 import glob
+import time
+import queue
+import threading
 import random
 import argparse
 import numpy as np
 import tkinter as tk
 
-import matplotlib
-matplotlib.use("TkAgg")
-import matplotlib.pyplot as plt
-import matplotlib.image as mpimg
-from matplotlib.backends.backend_tkagg import FigureCanvasTkAgg
-
 ROOT = os.path.dirname(os.path.abspath(__file__))
 getCachedPics = lambda x : glob.glob(os.path.join(ROOT, 'cropped/proccesed_img50/' + x + '*'))
+STORE_DIR = os.path.join(ROOT, 'cropped/stimulus_cache')
+
+class StimulusStore:
+    def __init__(self, categories, storeDir = STORE_DIR, size = (50,50)):
+        '''
+        Every picture of every category decoded once into a uint8 array of
+        shape N x 50 x 50, saved under cropped/stimulus_cache/ and memory-mapped
+        back. The arrays are only rebuilt when the pictures on disk change, so
+        picking a stimulus during a session is an array slice.
+        '''
+        self.storeDir = storeDir
+        self.size = size
+        self.paths = {}
+        self.images = {}
+        if not os.path.isdir(self.storeDir):
+            os.makedirs(self.storeDir)
+        for category in categories:
+            self.paths[category], self.images[category] = self.load(category)
+
+    def count(self, category):
+        return len(self.paths[category])
+
+    def get(self, category, idx):
+        return self.images[category][idx]
+
+    def read_picture(self, img_path):
+        #only needed when the store is rebuilt
+        import matplotlib.image as mpimg
+        img = mpimg.imread(img_path)
+        if img.ndim == 3:
+            #pictures are grayscale, first channel is enough
+            img = img[..., 0]
+        if img.dtype != np.uint8:
+            img = np.round(img * 255).astype(np.uint8)
+        return img
+
+    def load(self, category):
+        arrayFile = os.path.join(self.storeDir, category + '.npy')
+        indexFile = os.path.join(self.storeDir, category + '.txt')
+        paths = sorted(getCachedPics(category))
+        names = [os.path.basename(w) for w in paths]
+
+        #reuse the stored array if it indexes the same files and is newer than all of them
+        if os.path.isfile(arrayFile) and os.path.isfile(indexFile):
+            with open(indexFile) as f:
+                index = [line.rsplit(',', 1) for line in f.read().splitlines()]
+            newest = max([os.path.getmtime(w) for w in paths] + [0])
+            if [w[0] for w in index] == names and os.path.getmtime(arrayFile) >= newest:
+                keep = [path for path, (_, kept) in zip(paths, index) if kept == '1']
+                return keep, np.load(arrayFile, mmap_mode='r')
+
+        keep, images, index = [], [], []
+        for img_path in paths:
+            img = self.read_picture(img_path)
+            if img.shape != self.size:
+                print('%s is not %ix%i, leaving it out.' %((img_path,) + self.size))
+                index.append('%s,0' %os.path.basename(img_path))
+                continue
+            keep.append(img_path)
+            images.append(img)
+            index.append('%s,1' %os.path.basename(img_path))
+        images = np.stack(images) if images else np.zeros((0,) + self.size, dtype=np.uint8)
+        np.save(arrayFile, images)
+        with open(indexFile, 'w') as f:
+            f.write(''.join(w + '\n' for w in index))
+        return keep, np.load(arrayFile, mmap_mode='r')
+
+
+class StimulusSampler:
+    def __init__(self, store, seed = None):
+        '''
+        Draws pictures of each category without replacement. Every category gets
+        one shuffled permutation of its indices up front, so a draw is a pop and
+        the whole sequence is reproducible for a given seed.
+        '''
+        self.store = store
+        rng = random.Random(seed)
+        self.order = {}
+        for category in sorted(store.paths):
+            self.order[category] = list(range(store.count(category)))
+            rng.shuffle(self.order[category])
+
+    def remaining(self, category):
+        return len(self.order[category])
+
+    def draw(self, category):
+        if not self.order[category]:
+            raise ValueError('All %i pictures of %s have already been shown'
+                             %(self.store.count(category), category))
+        return self.order[category].pop()
+
+
+class FrameScheduler:
+    def __init__(self, window, draw, spinMs = 2):
+        '''
+        Shows a sequence of already prepared frames, each for a given number of
+        milliseconds. Flip deadlines are measured on time.perf_counter from the
+        start of the sequence, so the time it takes to draw one frame does not
+        push the following ones back. Tk timers fire spinMs early and the rest
+        is waited out on the clock. Every frame that reaches the screen gets an
+        entry in self.log with its scheduled, onset and offset times, and
+        whether cancel() cut it short.
+        '''
+        self.window = window
+        self.draw = draw
+        self.spin = spinMs / 1000.
+        self.log = []
+        self.pending = None
+        self.frames = []
+
+    def run(self, frames, delayMs = 0, trial = None):
+        '''
+        frames is a list of (label, frame, durationMs). Anything still scheduled
+        from a previous sequence is cancelled first.
+        '''
+        self.cancel()
+        self.frames = frames
+        self.trial = trial
+        self.deadlines = []
+        deadline = time.perf_counter() + delayMs / 1000.
+        for _, _, durationMs in frames:
+            self.deadlines.append(deadline)
+            deadline += durationMs / 1000.
+        self.schedule(0)
+
+    def schedule(self, idx):
+        if idx == len(self.frames):
+            self.pending = None
+            return
+        delay = self.deadlines[idx] - self.spin - time.perf_counter()
+        self.pending = self.window.after(max(0, int(delay * 1000)), self.flip, idx)
+        self.pendingIdx = idx
+
+    def flip(self, idx):
+        label, frame, durationMs = self.frames[idx]
+        while time.perf_counter() < self.deadlines[idx]:
+            pass
+        self.draw(frame)
+        self.window.update_idletasks()
+        onset = time.perf_counter()
+        if self.log and self.log[-1]['offset'] is None:
+            self.log[-1]['offset'] = onset
+        self.log.append({'trial' : self.trial,
+                         'frame' : label,
+                         'durationMs' : durationMs,
+                         'scheduled' : self.deadlines[idx],
+                         'onset' : onset,
+                         'offset' : None,
+                         'cutShort' : False})
+        self.schedule(idx + 1)
+
+    def onset(self, trial, label):
+        '''
+        Measured onset of the first frame with this label in a trial, None if
+        no such frame has been shown yet.
+        '''
+        found = None
+        for entry in reversed(self.log):
+            if entry['trial'] != trial:
+                break
+            if entry['frame'] == label:
+                found = entry['onset']
+        return found
+
+    def cancel(self):
+        if self.pending is not None:
+            #the frame on screen was still waiting for its successor
+            if self.pendingIdx > 0 and self.log:
+                self.log[-1]['cutShort'] = True
+            self.window.after_cancel(self.pending)
+            self.pending = None
+
+    def timing_report(self):
+        '''
+        Largest difference between intended and measured duration, and largest
+        onset lag, over every frame shown for a non zero duration that was not
+        cut short by cancel().
+        '''
+        shown = [w for w in self.log
+                 if w['durationMs'] and w['offset'] is not None and not w['cutShort']]
+        if not shown:
+            return 0., 0.
+        durationError = max(abs((w['offset'] - w['onset']) * 1000 - w['durationMs']) for w in shown)
+        onsetLag = max((w['onset'] - w['scheduled']) * 1000 for w in shown)
+        return durationError, onsetLag
+
+
+class SessionLogger:
+    COLUMNS = ['session', 'trial', 'category', 'stimulus', 'response', 'correct', 'rtMs']
+
+    def __init__(self, path, session = None):
+        '''
+        Writes one record per answered trial on a background thread, so logging
+        costs the Tk thread a queue put. A .csv log is appended to every time the
+        writer catches up and several sessions can share one file, told apart by
+        the session column. A .npz log holds one array per column and is written
+        on close, after any sessions already in it.
+        '''
+        self.path = path
+        self.session = session or time.strftime('%Y-%m-%dT%H:%M:%S')
+        self.rows = []
+        self.queue = queue.Queue()
+        self.thread = threading.Thread(target=self.worker, daemon=True)
+        self.thread.start()
+
+    def log(self, **record):
+        self.queue.put(dict(record, session=self.session))
+
+    def worker(self):
+        done = False
+        while not done:
+            batch = [self.queue.get()]
+            while not self.queue.empty():
+                batch.append(self.queue.get())
+            if batch[-1] is None:
+                batch.pop()
+                done = True
+            if self.path.endswith('.csv'):
+                self.append_csv(batch)
+            else:
+                self.rows += batch
+        if self.path.endswith('.npz'):
+            self.write_npz()
+
+    def append_csv(self, batch):
+        new = not os.path.isfile(self.path) or not os.path.getsize(self.path)
+        with open(self.path, 'a', newline='') as f:
+            writer = csv.DictWriter(f, self.COLUMNS)
+            if new:
+                writer.writeheader()
+            writer.writerows(batch)
+
+    def write_npz(self):
+        if not self.rows:
+            return
+        columns = {}
+        for name in self.COLUMNS:
+            values = [w[name] for w in self.rows]
+            if name == 'rtMs':
+                values = [np.nan if w is None else w for w in values]
+            columns[name] = np.array(values)
+        if os.path.isfile(self.path):
+            with np.load(self.path) as old:
+                columns = {w : np.concatenate([old[w], columns[w]]) for w in self.COLUMNS}
+        np.savez(self.path, **columns)
+
+    def close(self):
+        if self.thread.is_alive():
+            self.queue.put(None)
+            self.thread.join()
+
+
+class MatplotlibRenderer:
+    def __init__(self, window):
+        '''
+        Original renderer: frames go through imshow and a full Agg redraw of
+        the figure. matplotlib is imported here so the tk renderer never pays
+        for it.
+        '''
+        import matplotlib
+        matplotlib.use("TkAgg")
+        import matplotlib.pyplot as plt
+        from matplotlib.backends.backend_tkagg import FigureCanvasTkAgg
+        my_dpi = 192
+        fig, ax = plt.subplots(1,1,figsize=(50/my_dpi, 50/my_dpi), dpi=my_dpi)
+        self.pic = ax.imshow(np.zeros((50,50)), cmap=plt.get_cmap('gray'), vmin=0, vmax=255)
+        self.canvas = FigureCanvasTkAgg(fig, master=window)
+        self.canvas.draw()
+        self.widget = self.canvas.get_tk_widget()
+
+    def prepare(self, img, key = None):
+        return img
+
+    def draw(self, frame):
+        self.pic.set_data(frame)
+        self.canvas.draw()
+
+
+class PhotoImageRenderer:
+    def __init__(self, window, scale = 12):
+        '''
+        Lightweight renderer: each frame is uploaded once to a Tk PhotoImage as
+        binary PGM, upscaled with nearest neighbour by PhotoImage.zoom and cached
+        under its key, so drawing is just pointing a Label at another image.
+        '''
+        self.scale = scale
+        self.cache = {}
+        self.widget = tk.Label(window, bg='black', bd=0)
+
+    def prepare(self, img, key = None):
+        if key is not None and key in self.cache:
+            return self.cache[key]
+        img = np.ascontiguousarray(img, dtype=np.uint8)
+        header = ('P5 %i %i 255 ' %(img.shape[1], img.shape[0])).encode()
+        photo = tk.PhotoImage(data=header + img.tobytes(), format='PPM')
+        if self.scale > 1:
+            photo = photo.zoom(self.scale)
+        if key is not None:
+            self.cache[key] = photo
+        return photo
+
+    def draw(self, frame):
+        self.widget.configure(image=frame)
+
+RENDERERS = {'matplotlib' : MatplotlibRenderer,
+             'tk' : PhotoImageRenderer}
+
 
 class App:
     def __init__(self, window,
                        totalTrials = 10,
                        trialPresentation = 'single300',
                        categoryType = 'fruit',
-                       baseItem = 'apple'):
+                       baseItem = 'apple',
+                       seed = None,
+                       renderer = 'matplotlib',
+                       sessionLog = None):
 
         '''
         Sets up logic for running the task.
@@ -31,6 +339,7 @@ class App:
         self.trialPresentation = trialPresentation
         self.categoryType = categoryType
         self.baseItem = baseItem
+        self.rng = random.Random(seed)
 
         #alllowed categories and items within categories
         self.Cats = {'fruit' : ['apple','grape','banana','pineapple'],
@@ -60,13 +369,13 @@ class App:
             print('\tgestures')
             sys.exit(0)
         else:
+            self.store = StimulusStore(self.Cats[self.categoryType])
             for element in self.Cats[self.categoryType]:
-                items = getCachedPics(element)
-                if len(items) == 0:
+                if self.store.count(element) == 0:
                     print('Element %s has no pictures, EXITING' %element)
                     sys.exit(0)
                 else:
-                    print("We have %i pictures of %s" %(len(items), element))
+                    print("We have %i pictures of %s" %(self.store.count(element), element))
 
         if self.trialPresentation not in ['continuous','single300','triple300']:
             print('trialPresentation entered not valid, EXITING')
@@ -75,6 +384,15 @@ class App:
             print('\tsingle300')
             print('\ttriple300')
             sys.exit(0)
+        if renderer not in RENDERERS:
+            print('renderer entered not valid, EXITING')
+            print('Allowed renderers are:')
+            for s in sorted(RENDERERS):
+                print('\t%s' %s)
+            sys.exit(0)
+        if sessionLog and os.path.splitext(sessionLog)[1] not in ['.csv', '.npz']:
+            print('sessionLog should be a .csv or .npz file, EXITING')
+            sys.exit(0)
         if self.baseItem not in self.Cats[self.categoryType]:
             print('base item entered should be in the category, EXITING')
             print('you specified %s as base item' %self.baseItem)
@@ -86,13 +404,21 @@ class App:
         '''
         Generates trials in advanced. Half of the trials are of the target base
         item, the other half of any of the other items within that category. The
-        order of the trials is then randomly shuffled
+        order of the trials is then randomly shuffled. Pictures are drawn without
+        replacement, so every item needs at least as many pictures as trials.
         '''
         alternatives = [w for w in self.Cats[categoryType] if w != self.baseItem]
         self.trialTypes = [self.baseItem if w%2==0 \
-                                         else random.choice(alternatives)
+                                         else self.rng.choice(alternatives)
                                          for w in range(self.totalTrials)]
-        random.shuffle(self.trialTypes)
+        self.rng.shuffle(self.trialTypes)
+        self.sampler = StimulusSampler(self.store, seed = self.rng.random())
+        for element in set(self.trialTypes):
+            needed = self.trialTypes.count(element)
+            if needed > self.sampler.remaining(element):
+                print('Session needs %i pictures of %s but there are only %i, EXITING'
+                      %(needed, element, self.sampler.remaining(element)))
+                sys.exit(0)
 
         '''
         GUI parameters. Sets up window, buttons, canvas, and message box.
@@ -102,102 +428,114 @@ class App:
         self.window.geometry('1200x1000')
         self.frame = tk.Frame(window)
 
-        self.button_Yes = tk.Button(self.frame, text="YES", height = 10, width = 20, command=self.yes_decision)
+        #the buttons stay disabled until the first trial is on screen
+        self.stimulus = None
+        self.button_Yes = tk.Button(self.frame, text="YES", height = 10, width = 20,
+                                    command=self.yes_decision, state='disabled')
         self.button_Yes.pack(side="left")
-        self.button_No = tk.Button(self.frame, text="NO", height = 10, width = 20, command=self.no_decision)
+        self.button_No = tk.Button(self.frame, text="NO", height = 10, width = 20,
+                                   command=self.no_decision, state='disabled')
         self.button_No.pack(side="right")
 
         self.label = tk.Label(self.window,
                               text="Is there a %s in this picture?" %self.baseItem,
                               font=("Arial Bold", 50)).pack()
 
-        my_dpi = 192
-        fig, ax = plt.subplots(1,1,figsize=(50/my_dpi, 50/my_dpi), dpi=my_dpi)
-        self.pic = ax.imshow(np.zeros((50,50)), cmap=plt.get_cmap('gray'), vmin=0, vmax=1)
-        self.canvas = FigureCanvasTkAgg(fig, master=self.window)
-        self.canvas.draw()
-        self.canvas.get_tk_widget().pack(side='top', fill='both', expand=1)
+        self.renderer = RENDERERS[renderer](self.window)
+        self.renderer.widget.pack(side='top', fill='both', expand=1)
         self.frame.pack()
 
+        self.blankFrame = self.renderer.prepare(np.zeros((50,50), dtype=np.uint8), key='blank')
+        self.scheduler = FrameScheduler(self.window, self.draw_array)
+        self.logger = SessionLogger(sessionLog) if sessionLog else None
+
         #START SESSION!
         self.window.after(1000, self.next_trial)
 
 
-    def load_image(self, img_path):
-        return mpimg.imread(img_path)
-
-    def get_picture_cached(self, fruit, notAllowed = []):
+    def get_picture_cached(self, fruit):
         '''
-        It picks a picture at random of the given category, if it has not been
-        shown before. If there are a lot of trials it could get stuck in an
-        infinite loop because all pictures have been shown. That's why it will
-        only look 50 times, and quit the program if it exceeds that.
+        Picks a picture of the given category that has not been shown before in
+        this session.
         '''
-        cnt = 0
-        specificPic = random.choice(getCachedPics(fruit))
-        while specificPic in notAllowed and cnt < 50:
-            specificPic = random.choice(getCachedPics(fruit))
-            cnt += 1
-        notAllowed.append(specificPic)
+        specificPic = self.sampler.draw(fruit)
         #we print the picture in case it's not good, it gives us the name in the
         #terminal and that way we can manually delete it.
-        print(specificPic)
-        return self.load_image(specificPic)
-
-    def draw_array(self, img):
-        self.pic.set_data(img)
-        self.canvas.draw()
+        self.stimulus = self.store.paths[fruit][specificPic]
+        print(self.stimulus)
+        return self.renderer.prepare(self.store.get(fruit, specificPic), key=(fruit, specificPic))
 
-    def display_stimulus(self):
-        self.draw_array(self.get_picture_cached(self.trialTypes[self.currentTrial]))
+    def draw_array(self, frame):
+        self.renderer.draw(frame)
 
-    def blank_screen(self):
-        self.draw_array(np.zeros((50,50)))
+    def stimulus_frames(self):
+        '''
+        Frame sequence for the current trial, with the picture already loaded so
+        nothing but drawing happens once the sequence starts.
+        '''
+        im = self.get_picture_cached(self.trialTypes[self.currentTrial])
+        if self.trialPresentation == 'continuous':
+            return [('stimulus', im, 0)]
+        elif self.trialPresentation == 'single300':
+            return [('blank', self.blankFrame, 100),
+                    ('stimulus', im, 300),
+                    ('blank', self.blankFrame, 0)]
+        elif self.trialPresentation == 'triple300':
+            frames = []
+            for _ in range(3):
+                frames += [('stimulus', im, 300), ('blank', self.blankFrame, 100)]
+            #the last blank stays up until the answer, untimed like single300
+            return frames + [('blank', self.blankFrame, 0)]
 
     def yes_decision(self):
-        self.correct += (self.trialTypes[self.currentTrial] == self.baseItem)
-        self.currentTrial += 1
-        self.next_trial()
+        self.decision('yes')
 
     def no_decision(self):
-        self.correct += (self.trialTypes[self.currentTrial] != self.baseItem)
+        self.decision('no')
+
+    def decision(self, response):
+        '''
+        Scores the answer and logs it. The reaction time is taken from the
+        measured onset of the stimulus, None if it was answered before the
+        stimulus was shown.
+        '''
+        answered = time.perf_counter()
+        category = self.trialTypes[self.currentTrial]
+        correct = (category == self.baseItem) == (response == 'yes')
+        self.correct += correct
+        if self.logger is not None:
+            onset = self.scheduler.onset(self.currentTrial, 'stimulus')
+            self.logger.log(trial = self.currentTrial,
+                            category = category,
+                            stimulus = os.path.basename(self.stimulus) if self.stimulus else '',
+                            response = response,
+                            correct = int(correct),
+                            rtMs = None if onset is None else (answered - onset) * 1000)
         self.currentTrial += 1
         self.next_trial()
 
 
     def next_trial(self):
         if self.currentTrial < self.totalTrials:
-            if self.trialPresentation == 'continuous':
-                self.display_stimulus()
-            elif self.trialPresentation == 'single300':
-                self.window.after(100, self.display_stimulus)
-                self.window.after(300, self.blank_screen)
-            elif self.trialPresentation == 'triple300':
-                im = self.get_picture_cached(self.trialTypes[self.currentTrial])
-                for _ in range(3):
-                    self.draw_array(im)
-                    self.frame.after(300)
-                    self.blank_screen()
-                    self.frame.after(100)
+            self.scheduler.run(self.stimulus_frames(), trial = self.currentTrial)
+            self.button_Yes.config(state='normal')
+            self.button_No.config(state='normal')
 
         else:
+            self.scheduler.cancel()
+            self.button_Yes.config(state='disabled')
+            self.button_No.config(state='disabled')
+            durationError, onsetLag = self.scheduler.timing_report()
             print('*'*80)
             print('Total Score: %i/%i' %(self.correct, self.totalTrials))
+            print('Worst frame duration error: %.1fms, worst onset lag: %.1fms'
+                  %(durationError, onsetLag))
             print('*'*80)
             self.window.quit()
 
 
 
 if __name__ == '__main__':
-    print('''
-    This GUI draws pictures from ./cropped/proccesed_img50/.
-    If there are no pictures there, the program will not work!
-    Images should be processed to be grayscale and 50x50.
-    ''')
-    if not os.listdir(os.path.join(ROOT, 'cropped/proccesed_img50')):
-        print('There are no pictures in ./cropped/procces   ed_img50')
-        sys.exit(0)
-
     #command line argument parser
     parser = argparse.ArgumentParser(description='Image Recognition for Humans.')
     parser.add_argument('--trials', type=int, default = 10,
@@ -208,12 +546,35 @@ if __name__ == '__main__':
                         help = 'Present fruits, fruits and vegetables, etc.')
     parser.add_argument('--baseItem', type=str, default = 'apple',
                         help = 'The base category to compare against')
+    parser.add_argument('--seed', type=int, default = None,
+                        help = 'Seed for trial order and picture selection.')
+    parser.add_argument('--renderer', type=str, default = 'matplotlib',
+                        help = 'How frames are drawn: matplotlib or tk (direct PhotoImage).')
+    parser.add_argument('--sessionLog', type=str, default = '',
+                        help = 'Append one record per trial to this .csv (or .npz) file.')
     args = parser.parse_args()
 
+    print('''
+    This GUI draws pictures from ./cropped/proccesed_img50/.
+    If there are no pictures there, the program will not work!
+    Images should be processed to be grayscale and 50x50.
+    ''')
+    picDir = os.path.join(ROOT, 'cropped/proccesed_img50')
+    if not os.path.isdir(picDir) or not os.listdir(picDir):
+        print('There are no pictures in ./cropped/procces   ed_img50')
+        sys.exit(0)
+
 
     root = tk.Tk()
     app = App(root, totalTrials = args.trials,
                     trialPresentation = args.trialPresentation,
                     categoryType = args.categoryType,
-                    baseItem = args.baseItem)
+                    baseItem = args.baseItem,
+                    seed = args.seed,
+                    renderer = args.renderer,
+                    sessionLog = args.sessionLog)
     root.mainloop()
+    if app.logger is not None:
+        #also reached when the window is closed mid-session
+        app.logger.close()
+        print('Session log written to %s' %args.sessionLog)
@@ -1,8 +1,174 @@
 import os
+import re
 import glob
+import json
+import queue
+import threading
+from collections import OrderedDict
 import pygame
 from pygame.locals import K_RIGHT, K_LEFT, QUIT
 from PIL import Image
+from metrics import PROFILER
+from encoding import output_name, save_image
+
+class Prefetcher():
+    def __init__(self, files, radius = 2, maxBytes = 512 * 2**20):
+        '''
+        Loads images on a background thread so moving to the next or previous
+        picture does not wait on the decoder. After every get, the radius images
+        on each side are queued, nearest first. Decoded surfaces are kept in an
+        LRU cache trimmed to maxBytes. The current image and its neighbours are
+        only evicted to make room for nearer ones, never for farther ones.
+        '''
+        self.files = files
+        self.radius = radius
+        self.maxBytes = maxBytes
+        self.surfaces = OrderedDict()
+        self.nbytes = 0
+        self.current = None
+        self.wanted = []
+        self.neighbours = []
+        self.loading = None
+        self.running = True
+        self.cond = threading.Condition()
+        self.thread = threading.Thread(target=self.worker, daemon=True)
+        self.thread.start()
+
+    def get(self, idx):
+        '''
+        Surface for self.files[idx], loading it right away if it has not been
+        prefetched. Raises IndexError past either end of the list.
+        '''
+        if idx < 0:
+            raise IndexError(idx)
+        path = self.files[idx]
+        with self.cond:
+            self.current = path
+            while self.loading == path:
+                self.cond.wait()
+            px = self.surfaces.get(path)
+            if px is not None:
+                self.surfaces.move_to_end(path)
+        if px is None:
+            px = pygame.image.load(path)
+            with self.cond:
+                self.store(path, px)
+        with self.cond:
+            self.wanted = []
+            for step in range(1, self.radius + 1):
+                self.wanted += [w for w in (idx + step, idx - step) if 0 <= w < len(self.files)]
+            #nearest first, the current image ranks before all of them
+            self.neighbours = [path] + [self.files[w] for w in self.wanted]
+            self.cond.notify_all()
+        return px
+
+    def rank(self, path):
+        if path in self.neighbours:
+            return self.neighbours.index(path)
+        return len(self.neighbours)
+
+    def store(self, path, px):
+        #caller holds self.cond
+        if path in self.surfaces:
+            return
+        self.surfaces[path] = px
+        self.nbytes += px.get_pitch() * px.get_height()
+        rank = self.rank(path)
+        #least recently used first, skipping anything nearer than the new image
+        for old in list(self.surfaces):
+            if self.nbytes <= self.maxBytes:
+                break
+            if old == self.current or (old != path and self.rank(old) < rank):
+                continue
+            self.nbytes -= self.surfaces[old].get_pitch() * self.surfaces[old].get_height()
+            del self.surfaces[old]
+
+    def worker(self):
+        while True:
+            with self.cond:
+                while self.running and not self.wanted:
+                    self.cond.wait()
+                if not self.running:
+                    return
+                path = self.files[self.wanted.pop(0)]
+                if path in self.surfaces:
+                    #still a neighbour, keep it away from the eviction end
+                    self.surfaces.move_to_end(path)
+                    continue
+                self.loading = path
+            try:
+                px = pygame.image.load(path)
+            except pygame.error as e:
+                print("Could not prefetch %s: %s" %(path, e))
+                px = None
+            with self.cond:
+                if px is not None:
+                    self.store(path, px)
+                self.loading = None
+                self.cond.notify_all()
+
+    def close(self):
+        with self.cond:
+            self.running = False
+            self.cond.notify_all()
+        self.thread.join()
+
+
+class CropWriter():
+    def __init__(self, manifest = None):
+        '''
+        Encodes and writes crops on a background thread so saving hands control
+        back to the operator straight away. close() waits for pending writes.
+        If a manifest path is given, every crop that was written is appended to
+        it as one json line, see image_pipeline.py --replay.
+        '''
+        self.manifest = manifest
+        self.queue = queue.Queue()
+        self.thread = threading.Thread(target=self.worker, daemon=True)
+        self.thread.start()
+
+    def submit(self, im, path, record = None, **params):
+        self.queue.put((im, path, record, params))
+
+    def worker(self):
+        while True:
+            job = self.queue.get()
+            if job is None:
+                return
+            im, path, record, params = job
+            try:
+                save_image(im, path, **params)
+            except Exception as e:
+                print("Could not save %s: %s" %(path, e))
+                continue
+            if self.manifest and record is not None:
+                with open(self.manifest, 'a') as f:
+                    f.write(json.dumps(record) + '\n')
+            print("saved %s" %os.path.basename(path))
+
+    def close(self):
+        self.queue.put(None)
+        self.thread.join()
+
+
+def clip_box(px, box):
+    left, upper, right, lower = box
+    return pygame.Rect(left, upper, right - left, lower - upper).clip(px.get_rect())
+
+def crop_surface(px, box):
+    '''
+    Crops box = (left, upper, right, lower) out of an already decoded pygame
+    surface. The subsurface shares pixels with px, so only the cropped region
+    is copied into the PIL image. Returns None if nothing is left after clipping
+    the box to the image.
+    '''
+    rect = clip_box(px, box)
+    if not (rect.width and rect.height):
+        return None
+    mode = 'RGBA' if px.get_flags() & pygame.SRCALPHA else 'RGB'
+    tobytes = getattr(pygame.image, 'tobytes', None) or pygame.image.tostring
+    return Image.frombytes(mode, rect.size, tobytes(px.subsurface(rect), mode))
+
 
 class ImageCropper():
     def __init__(self, infile_folder = '.',
@@ -10,7 +176,12 @@ class ImageCropper():
                        outfile_folder = './cropped',
                        outfile_prefix = '',
                        outfile_extension = 'png',
-                       resolution = 300):
+                       resolution = 300,
+                       maxFps = 60,
+                       prefetch = 2,
+                       cacheMB = 512,
+                       manifest = None,
+                       encoding = 'default'):
         '''
         Cropper object needs information on input and output folder and certain
         names for knowing which files to select and process.
@@ -23,6 +194,13 @@ class ImageCropper():
         self.pos = [0,0]
         self.BG_COLOR = (0,0,0)
         self.resolution = resolution
+        self.encoding = encoding
+        self.maxFps = maxFps
+        self.clock = pygame.time.Clock()
+        #self.px is the image as loaded, self.scaled its copy at display scale
+        self.scaled = None
+        self.scaledFor = None
+        self.box = None
 
         #create list of files matching prefix in folder, and sort it
         self.infiles = [w for w in glob.glob(os.path.join(infile_folder, infile_prefix) + '*.png')]
@@ -34,37 +212,80 @@ class ImageCropper():
         self.file_idx = 0
         self.input_loc = lambda : self.infiles[self.file_idx]
 
-        #get files begining with output prefix to make sure we don't overwrite files
-        self.out_idx = len([w for w in glob.glob(os.path.join(outfile_folder, outfile_prefix) + '*') if os.path.isfile(w)])
+        #continue after the highest index with the output prefix, so we don't overwrite
+        #files even if some were removed in between
+        taken = [re.match(re.escape(outfile_prefix) + r'(\d+)\.', os.path.basename(w))
+                 for w in glob.glob(os.path.join(outfile_folder, outfile_prefix) + '*')]
+        self.out_idx = max([int(w.group(1)) + 1 for w in taken if w] + [0])
         self.output_loc = lambda : os.path.join(outfile_folder, outfile_prefix + str(self.out_idx).zfill(3) + '.' + outfile_extension)
+        if encoding != 'default':
+            #the profile decides the format, and so the extension
+            name = self.output_loc
+            self.output_loc = lambda : output_name(name(), encoding)
+
+        #crops are encoded and written in the background
+        self.writer = CropWriter(manifest = manifest)
+
+        #images are decoded in the background, prefetch on each side of the current one
+        self.loader = Prefetcher(self.infiles, radius = prefetch, maxBytes = cacheMB * 2**20)
 
         #initialize graphics window / render it
-        self.px = pygame.image.load(self.input_loc())
+        self.px = self.loader.get(self.file_idx)
         self.screen = pygame.display.set_mode([self.px.get_rect().width,\
                                                self.px.get_rect().height])
         self.screen.blit(self.px, self.px.get_rect())
         pygame.display.flip()
 
-    def displayRect(self):
+    def set_image(self, px):
+        '''
+        Switches to a new image and drops the cached display copy.
+        '''
+        self.px = px
+        self.scaled = None
+        self.pos = [0,0]
+
+    def scaled_image(self):
+        '''
+        Image at display scale. Only rebuilt from the original when the scale
+        changes, so the original is never degraded by repeated scaling.
+        '''
+        if self.scaled is None or self.scaledFor != self.scale:
+            if self.scale == 1:
+                self.scaled = self.px
+            else:
+                rect = self.px.get_rect()
+                self.scaled = pygame.transform.scale(self.px, [int(rect.width/self.scale),
+                                                               int(rect.height/self.scale)])
+            self.scaledFor = self.scale
+        return self.scaled
+
+    def restore(self, rect):
         '''
-        Draws gray rectangle so user knows what you're intending to crop
+        Paints the image back over rect (screen coordinates).
+        '''
+        self.screen.fill(self.BG_COLOR, rect)
+        area = rect.move(self.pos[0], self.pos[1])
+        self.screen.blit(self.scaled_image(), rect.topleft, area)
+
+    def displayRect(self, mouse = None):
+        '''
+        Draws gray rectangle so user knows what you're intending to crop. Only the
+        areas covered by the previous and the new rectangle are redrawn. mouse
+        defaults to the current pointer position.
         '''
         if self.topleft == None:
             #func was called without a topleft, which means clear the previous rectangle
             self.screen.fill(self.BG_COLOR)
-            rect = self.px.get_rect()
-            self.px = pygame.transform.scale(self.px, [int(rect.width/self.scale),\
-                                                       int(rect.height/self.scale)])
-            self.screen.blit(self.px, (rect[0] - self.pos[0], rect[1] - self.pos[1]))
+            self.screen.blit(self.scaled_image(), (-self.pos[0], -self.pos[1]))
             pygame.display.flip()
+            self.box = None
             return None
 
         #or, the usual situation, topleft is defined, so blit over the old rect and blit in the new.
-        self.topleft = [(val/self.scale - self.pos[i]) for i, val in enumerate(self.topleft)]
-        x, y = self.topleft
-        bottomright = pygame.mouse.get_pos()
-        width =  bottomright[0] - self.topleft[0]
-        height = bottomright[1] - self.topleft[1]
+        x, y = [(val/self.scale - self.pos[i]) for i, val in enumerate(self.topleft)]
+        bottomright = mouse or pygame.mouse.get_pos()
+        width =  bottomright[0] - x
+        height = bottomright[1] - y
         if width < 0:
             x += width
             width = abs(width)
@@ -79,20 +300,23 @@ class ImageCropper():
         if current == self.prior:
             return current
 
-        # draw transparent box and blit it onto canvas
-        rect = self.px.get_rect()
-        self.px = pygame.transform.scale(self.px, [int(rect.width/self.scale),
-                                                   int(rect.height/self.scale)])
-        self.screen.blit(self.px, (rect[0] - self.pos[0],rect[1] - self.pos[1]))
+        dirty = []
+        if self.box is not None:
+            self.restore(self.box)
+            dirty.append(self.box)
+        box = pygame.Rect([int(w) for w in current])
+        self.restore(box)
         #draw gray rectangle
-        im = pygame.Surface((width, height))
+        im = pygame.Surface((box.width, box.height))
         im.fill((128, 128, 128))
         pygame.draw.rect(im, (32, 32, 32), im.get_rect(), 1)
         im.set_alpha(128)
-        self.screen.blit(im, (x, y))
-        pygame.display.flip()
+        self.screen.blit(im, box.topleft)
+        dirty.append(box)
+        self.box = box
+        pygame.display.update(dirty)
         # return current box extents
-        return (x, y, width, height)
+        return current
 
 
     def mainloop(self):
@@ -103,10 +327,14 @@ class ImageCropper():
         pygame.init()
         runForever = 1
         while runForever:
+            #no point redrawing faster than the display refreshes
+            self.clock.tick(self.maxFps)
             for event in pygame.event.get():
 
                 if event.type == QUIT:
                     runForever = 0
+                    self.loader.close()
+                    self.writer.close()
                     pygame.display.quit()
                     pygame.quit()
 
@@ -120,12 +348,11 @@ class ImageCropper():
                 if event.type == pygame.KEYDOWN and event.key == K_RIGHT:
                     self.file_idx += 1
                     try:
-                        self.px = pygame.image.load(self.input_loc())
+                        self.set_image(self.loader.get(self.file_idx))
                     except IndexError:
                         self.file_idx -= 1
                         print("End of album")
                     else:
-                        pos = [0,0]
                         self.topleft = self.bottomright = self.prior = None
                         self.prior = self.displayRect()
 
@@ -134,8 +361,7 @@ class ImageCropper():
                         print("This is the begining of the album, cannot go back a page.")
                     else:
                         self.file_idx -= 1
-                        self.px = pygame.image.load(self.input_loc())
-                        pos = [0,0]
+                        self.set_image(self.loader.get(self.file_idx))
                         self.topleft = self.bottomright = self.prior = None
                         self.prior = self.displayRect()
 
@@ -153,16 +379,23 @@ class ImageCropper():
                     if lower < upper:
                         lower, upper = upper, lower
 
-                    #actual cropping happens here
-                    im = Image.open(self.input_loc())
-                    im = im.crop((int(left), int(upper), int(right), int(lower)))
+                    #actual cropping happens here, from the pixels already on screen
+                    box = (int(left), int(upper), int(right), int(lower))
+                    with PROFILER.stage('crop'):
+                        im = crop_surface(self.px, box)
                     #if coordinates were valid we save the image
-                    if im.getbbox() != None:
-                        im.save(self.output_loc(), dpi = (self.resolution, self.resolution))
+                    if im is not None and im.getbbox() != None:
+                        rect = clip_box(self.px, box)
+                        record = {'source' : os.path.abspath(self.input_loc()),
+                                  'box' : [rect.left, rect.top, rect.right, rect.bottom],
+                                  'output' : os.path.basename(self.output_loc()),
+                                  'resolution' : self.resolution}
+                        self.writer.submit(im, self.output_loc(), record = record,
+                                           encoding = self.encoding,
+                                           dpi = (self.resolution, self.resolution))
                         self.out_idx += 1
                         self.topleft = self.bottomright = self.prior = None
                         self.prior = self.displayRect()
-                        print("saved")
                     else:
                         self.topleft = self.bottomright = self.prior = None
                         print("Not valid mouse selection")
@@ -0,0 +1,343 @@
+import os
+import sys
+import json
+import time
+import shutil
+import platform
+import argparse
+import tempfile
+import threading
+import resource
+import multiprocessing
+import numpy as np
+
+'''
+Benchmarks for the image pipeline stages and the GUI render paths.
+
+Stages run on a synthetic corpus, each one in its own process whose RSS, pool
+workers included, is sampled while the stage runs. Render paths are timed per
+frame: ImageCropper.displayRect with SDL's dummy video driver, FRUIT_GUI
+renderers in a Tk window (skipped when there is no display).
+'''
+STAGES = ['convert', 'downsample', 'darkpad', 'pipeline', 'pyramid', 'pack']
+PYRAMID = '32,50,64,128,50:120'
+#stages that read what an earlier one wrote
+DEPENDS = {'downsample' : ['convert'], 'darkpad' : ['downsample']}
+
+def make_corpus(folder, count = 100, width = 1600, height = 1200, seed = 0):
+    '''
+    Writes count jpgs of smooth gradients plus noise, which compress roughly like
+    photos, and returns their paths.
+    '''
+    from PIL import Image
+    rng = np.random.RandomState(seed)
+    y, x = np.mgrid[0:height, 0:width]
+    paths = []
+    for idx in range(count):
+        fx, fy = rng.uniform(0.002, 0.02, size=2)
+        base = (np.sin(x * fx + idx) + np.cos(y * fy)) * 60 + 128
+        rgb = np.stack([base, base[::-1], base[:, ::-1]], axis=-1)
+        rgb += rng.normal(0, 8, size=rgb.shape)
+        path = os.path.join(folder, 'bench%05i.jpg' %idx)
+        Image.fromarray(np.clip(rgb, 0, 255).astype(np.uint8)).save(path, quality=90)
+        paths.append(path)
+    return paths
+
+def with_dependencies(stages):
+    needed = set()
+    def add(stage):
+        for w in DEPENDS.get(stage, []):
+            add(w)
+        needed.add(stage)
+    for stage in stages:
+        add(stage)
+    return [w for w in STAGES if w in needed]
+
+def peak_rss_mb():
+    #high-water mark, inherited across fork and exec, so only an upper bound
+    scale = 1 if sys.platform == 'darwin' else 1024
+    own = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    children = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss
+    return max(own, children) * scale / 2.**20
+
+def tree_rss_mb(pid):
+    '''
+    Current RSS of pid plus all its descendants, from /proc.
+    '''
+    total, todo = 0, [pid]
+    while todo:
+        pid = todo.pop()
+        try:
+            with open('/proc/%i/status' %pid) as f:
+                for line in f:
+                    if line.startswith('VmRSS:'):
+                        total += int(line.split()[1])
+            for task in os.listdir('/proc/%i/task' %pid):
+                with open('/proc/%i/task/%s/children' %(pid, task)) as f:
+                    todo += [int(w) for w in f.read().split()]
+        except (IOError, OSError):
+            #exited while we looked
+            continue
+    return total / 1024.
+
+class RssSampler():
+    def __init__(self, interval = 0.01):
+        '''
+        Samples the RSS of this process and its children every interval
+        seconds on a thread, keeping the peak. Falls back on the rusage
+        high-water mark where there is no /proc.
+        '''
+        self.interval = interval
+        self.peak = 0.
+        self.proc = os.path.isfile('/proc/self/status')
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self.worker, daemon=True)
+
+    def worker(self):
+        while not self.stopped.wait(self.interval):
+            self.peak = max(self.peak, tree_rss_mb(os.getpid()))
+
+    def __enter__(self):
+        if self.proc:
+            self.peak = tree_rss_mb(os.getpid())
+            self.thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        if self.proc:
+            self.stopped.set()
+            self.thread.join()
+        else:
+            self.peak = peak_rss_mb()
+        return False
+
+def folder_bytes(files):
+    return sum(os.path.getsize(w) for w in files)
+
+def _run_stage(stage, corpus, work, workers):
+    import image_pipeline as ip
+    convertDir = os.path.join(work, 'convert')
+    downDir = os.path.join(work, 'downsample')
+    padDir = os.path.join(work, 'darkpad')
+    fusedDir = os.path.join(work, 'pipeline')
+    pyramidDir = os.path.join(work, 'pyramid')
+    if stage == 'convert':
+        os.mkdir(convertDir)
+        inputs = ip.list_images(corpus)
+        run = lambda: ip.convert_jpg_to_png(corpus, outputDir=convertDir, workers=workers)
+    elif stage == 'downsample':
+        shutil.copytree(convertDir, downDir)
+        inputs = ip.list_images(downDir)
+        run = lambda: ip.create_50x50(downDir, workers=workers)
+    elif stage == 'darkpad':
+        os.mkdir(padDir)
+        inputs = ip.list_images(downDir)
+        run = lambda: ip.create_120x120_darkpad(downDir, outputDir=padDir, workers=workers)
+    elif stage == 'pipeline':
+        os.mkdir(fusedDir)
+        inputs = ip.list_images(corpus)
+        pipeline = ip.Pipeline(draftSize=(50, 50)).add(ip.to_grayscale)\
+                                                  .add(ip.downsample, outputDir=fusedDir)\
+                                                  .add(ip.darkpad, outputDir=fusedDir, size=120)
+        run = lambda: pipeline.run(inputs, workers=workers)
+    elif stage == 'pyramid':
+        inputs = ip.list_images(corpus)
+        pyramid = ip.Pyramid(ip.parse_levels(PYRAMID), outputDir=pyramidDir)
+        run = lambda: pyramid.run(inputs, workers=workers)
+    elif stage == 'pack':
+        inputs = ip.list_images(corpus)
+        run = lambda: ip.pack_images(inputs, padSize=120, workers=workers)
+    #measured before running, downsample overwrites its inputs
+    nbytes = folder_bytes(inputs)
+    with RssSampler() as rss:
+        start = time.perf_counter()
+        run()
+        seconds = time.perf_counter() - start
+    return {'files' : len(inputs),
+            'seconds' : seconds,
+            'images_per_s' : len(inputs) / seconds,
+            'mb_per_s' : nbytes / 1e6 / seconds,
+            'peak_rss_mb' : rss.peak}
+
+def _stage_child(conn, stage, corpus, work, workers):
+    #progress lines would only add noise to the timings
+    sys.stdout = open(os.devnull, 'w')
+    try:
+        conn.send(_run_stage(stage, corpus, work, workers))
+    except Exception as e:
+        conn.send({'error' : '%s: %s' %(type(e).__name__, e)})
+    conn.close()
+
+def benchmark_stage(stage, corpus, work, workers = 1):
+    #spawned, not forked, so the stage process does not hold a copy of our memory
+    ctx = multiprocessing.get_context('spawn')
+    parent, child = ctx.Pipe()
+    proc = ctx.Process(target=_stage_child, args=(child, stage, corpus, work, workers))
+    proc.start()
+    result = parent.recv()
+    proc.join()
+    return result
+
+
+'''
+Render paths. Frames are timed the way they are shown: displayRect including
+its display update, renderers as draw plus update_idletasks like FrameScheduler.
+'''
+def latency_summary(samples):
+    samples = np.asarray(samples) * 1000
+    return {'mean_ms' : float(samples.mean()),
+            'p50_ms' : float(np.percentile(samples, 50)),
+            'p90_ms' : float(np.percentile(samples, 90)),
+            'p99_ms' : float(np.percentile(samples, 99)),
+            'max_ms' : float(samples.max())}
+
+def benchmark_cropper(image_file, frames = 200):
+    '''
+    Drags a selection diagonally across the image, one displayRect per frame.
+    '''
+    os.environ.setdefault('SDL_VIDEODRIVER', 'dummy')
+    import pygame
+    from ImageCropper import ImageCropper
+    pygame.init()
+    folder = tempfile.mkdtemp()
+    shutil.copy(image_file, os.path.join(folder, 'bench.png'))
+    cropper = ImageCropper(infile_folder = folder, outfile_folder = folder,
+                           outfile_prefix = 'out', prefetch = 0)
+    width, height = cropper.px.get_size()
+    cropper.topleft = [width // 10, height // 10]
+    drawTimes = []
+    for idx in range(frames):
+        mouse = (width // 10 + 1 + idx * (width // 2) // frames,
+                 height // 10 + 1 + idx * (height // 2) // frames)
+        start = time.perf_counter()
+        cropper.prior = cropper.displayRect(mouse)
+        drawTimes.append(time.perf_counter() - start)
+    cropper.loader.close()
+    cropper.writer.close()
+    pygame.quit()
+    shutil.rmtree(folder)
+    return {'draw' : latency_summary(drawTimes)}
+
+def benchmark_renderer(name, frames = 200, stimuli = 20, seed = 0):
+    '''
+    Draws frames alternating between random 50x50 stimuli and a blank frame.
+    Returns latency summaries for preparing a stimulus and for drawing one.
+    '''
+    import tkinter as tk
+    from FRUIT_GUI import RENDERERS
+    rng = np.random.RandomState(seed)
+    images = rng.randint(0, 256, size=(stimuli, 50, 50)).astype(np.uint8)
+
+    window = tk.Tk()
+    window.geometry('1200x1000')
+    renderer = RENDERERS[name](window)
+    renderer.widget.pack(side='top', fill='both', expand=1)
+    window.update()
+
+    prepareTimes, drawTimes = [], []
+    blank = renderer.prepare(np.zeros((50,50), dtype=np.uint8), key='blank')
+    prepared = []
+    for idx, img in enumerate(images):
+        start = time.perf_counter()
+        prepared.append(renderer.prepare(img, key=idx))
+        prepareTimes.append(time.perf_counter() - start)
+    for idx in range(frames):
+        frame = prepared[(idx // 2) % stimuli] if idx % 2 == 0 else blank
+        start = time.perf_counter()
+        renderer.draw(frame)
+        window.update_idletasks()
+        drawTimes.append(time.perf_counter() - start)
+        window.update()
+    window.destroy()
+    return {'prepare' : latency_summary(prepareTimes),
+            'draw' : latency_summary(drawTimes)}
+
+
+def environment():
+    import PIL
+    return {'python' : platform.python_version(),
+            'platform' : platform.platform(),
+            'cpus' : os.cpu_count(),
+            'pillow' : PIL.__version__,
+            'numpy' : np.__version__,
+            'time' : time.strftime('%Y-%m-%dT%H:%M:%S')}
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmarks for the image pipeline and GUI.')
+    parser.add_argument('--count', type=int, default = 100,
+                        help = 'Number of images in the synthetic corpus.')
+    parser.add_argument('--width', type=int, default = 1600,
+                        help = 'Width of the synthetic images.')
+    parser.add_argument('--height', type=int, default = 1200,
+                        help = 'Height of the synthetic images.')
+    parser.add_argument('--workers', type=int, default = 1,
+                        help = 'Number of processes for the batch stages, 0 uses every core.')
+    parser.add_argument('--stages', type=str, default = ','.join(STAGES),
+                        help = 'Comma separated pipeline stages to time, empty for none. downsample '
+                               'needs convert and darkpad needs downsample, those are added and '
+                               'timed too.')
+    parser.add_argument('--renderers', type=str, default = 'cropper,matplotlib,tk',
+                        help = 'Comma separated render paths to time, empty for none.')
+    parser.add_argument('--frames', type=int, default = 200,
+                        help = 'Number of frames drawn per render path.')
+    parser.add_argument('--output', type=str, default = '',
+                        help = 'Write the results to this json file.')
+    args = parser.parse_args()
+
+    stages = [w for w in args.stages.split(',') if w]
+    renderers = [w for w in args.renderers.split(',') if w]
+    for stage in stages:
+        if stage not in STAGES:
+            print('Unknown stage %s, must be one of %s! EXITING' %(stage, ', '.join(STAGES)))
+            sys.exit(0)
+    added = [w for w in with_dependencies(stages) if w not in stages]
+    if added:
+        print('Also running %s, which the requested stages depend on.' %', '.join(added))
+        stages = with_dependencies(stages)
+
+    work = tempfile.mkdtemp()
+    corpus = os.path.join(work, 'corpus')
+    os.mkdir(corpus)
+    print('Generating %i images of %ix%i...' %(args.count, args.width, args.height))
+    paths = make_corpus(corpus, args.count, args.width, args.height)
+
+    results = {'environment' : environment(), 'args' : vars(args), 'stages' : {}, 'render' : {}}
+    if stages:
+        print('%-12s %8s %10s %10s %10s' %('stage', 'seconds', 'images/s', 'MB/s', 'peak MB'))
+    for stage in stages:
+        r = benchmark_stage(stage, corpus, work, workers = args.workers)
+        results['stages'][stage] = r
+        if 'error' in r:
+            print('%-12s %s' %(stage, r['error']))
+        else:
+            print('%-12s %8.2f %10.1f %10.1f %10.1f' %(stage, r['seconds'], r['images_per_s'],
+                                                       r['mb_per_s'], r['peak_rss_mb']))
+
+    if renderers:
+        print('%-12s %-8s %9s %9s %9s %9s %9s' %('render', 'step', 'mean_ms',
+                                                'p50_ms', 'p90_ms', 'p99_ms', 'max_ms'))
+    for name in renderers:
+        try:
+            if name == 'cropper':
+                from PIL import Image
+                png = os.path.join(work, 'cropper.png')
+                Image.open(paths[0]).save(png)
+                r = benchmark_cropper(png, frames = args.frames)
+            else:
+                r = benchmark_renderer(name, frames = args.frames)
+        except Exception as e:
+            #most likely no display for Tk
+            print('%-12s skipped (%s)' %(name, e))
+            results['render'][name] = {'error' : str(e)}
+            continue
+        results['render'][name] = r
+        for step in sorted(r):
+            print('%-12s %-8s %9.2f %9.2f %9.2f %9.2f %9.2f' %(name, step, r[step]['mean_ms'],
+                  r[step]['p50_ms'], r[step]['p90_ms'], r[step]['p99_ms'], r[step]['max_ms']))
+
+    shutil.rmtree(work)
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+        print('Results written to %s' %args.output)
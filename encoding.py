@@ -0,0 +1,67 @@
+import io
+import os
+import zlib
+from PIL import Image, ImageChops, features
+from metrics import PROFILER
+
+'''
+Encoding profiles for every image the project writes.
+
+'default' is PIL's png settings, as before. The other profiles also store the
+image in the fewest channels that hold the same pixels: an alpha channel that
+is fully opaque is dropped and RGB images whose three channels are equal are
+stored as 'L'. Decoding gives back the same pixel values, only without the
+redundant channels. 'webp' writes lossless WebP instead of png.
+'''
+ENCODING_PROFILES = {'default' : {'extension' : 'png', 'reduce' : False, 'params' : {}},
+                     'fast' : {'extension' : 'png', 'reduce' : True,
+                               'params' : {'compress_level' : 1, 'compress_type' : zlib.Z_RLE}},
+                     'balanced' : {'extension' : 'png', 'reduce' : True,
+                                   'params' : {'compress_level' : 6}},
+                     'small' : {'extension' : 'png', 'reduce' : True,
+                                'params' : {'compress_level' : 9, 'optimize' : True}},
+                     'webp' : {'extension' : 'webp', 'reduce' : True,
+                               'params' : {'lossless' : True, 'quality' : 100, 'exact' : True}}}
+
+def available_profiles():
+    return sorted(w for w in ENCODING_PROFILES
+                  if ENCODING_PROFILES[w]['extension'] != 'webp' or features.check('webp'))
+
+def output_name(name, encoding = 'default'):
+    return os.path.splitext(name)[0] + '.' + ENCODING_PROFILES[encoding]['extension']
+
+def reduce_channels(im):
+    '''
+    Same pixels in fewer channels: drops an opaque alpha channel and turns RGB
+    with equal channels into L.
+    '''
+    if im.mode in ('LA', 'RGBA') and im.getextrema()[-1] == (255, 255):
+        im = im.convert(im.mode[:-1])
+    if im.mode == 'RGB':
+        r, g, b = im.split()
+        if ImageChops.difference(r, g).getbbox() is None and \
+           ImageChops.difference(r, b).getbbox() is None:
+            im = r
+    return im
+
+def save_image(im, path, encoding = 'default', **params):
+    '''
+    im.save with the settings of an encoding profile. path is written as given,
+    use output_name to get the profile's extension. When profiling, encoding
+    and writing the file are timed as separate stages.
+    '''
+    profile = ENCODING_PROFILES[encoding]
+    if profile['reduce']:
+        im = reduce_channels(im)
+    params = dict(profile['params'], **params)
+    if not PROFILER.enabled:
+        im.save(path, **params)
+        return
+    with PROFILER.stage('encode'):
+        buf = io.BytesIO()
+        im.save(buf, format=Image.registered_extensions()[os.path.splitext(path)[1].lower()],
+                **params)
+    with PROFILER.stage('write'):
+        with open(path, 'wb') as f:
+            f.write(buf.getbuffer())
+    PROFILER.count_written('write', buf.tell())
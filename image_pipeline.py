@@ -1,44 +1,476 @@
 import os
 import sys
-import glob
+import json
+import hashlib
+import queue
+import threading
 import argparse
+import itertools
+import numpy as np
+import multiprocessing
+from functools import partial
 from shutil import copyfile, rmtree
 from PIL import Image
-from ImageCropper import ImageCropper
+from metrics import PROFILER
+from encoding import available_profiles, output_name, save_image
 
 ROOT = os.path.dirname(os.path.abspath(__file__))
 
+'''
+Batch engine. Every stage below is written as a function that handles a single
+file, and run_batch fans those files out to a pool of worker processes. Results
+come back in input order so progress lines read the same as a serial run, and
+an exception in one file is reported instead of aborting the whole folder.
+'''
+def _init_worker(profile):
+    #forked workers would otherwise start with a copy of what the parent recorded
+    PROFILER.reset()
+    if profile:
+        PROFILER.enable()
+
+def _safe_call(func, item, profile = False):
+    #with profile, whatever the worker recorded for this item travels back with it
+    try:
+        result, error = func(item), None
+    except Exception as e:
+        result, error = None, '%s: %s' %(type(e).__name__, e)
+    return item, result, error, PROFILER.snapshot() if profile else None
+
+def _item_name(item):
+    #jobs are either a path or a tuple starting with one
+    if isinstance(item, tuple):
+        item = item[0]
+    return os.path.basename(str(item))
+
+def run_batch(func, items, workers=1, chunksize=None, verbose=True):
+    '''
+    Applies func to every item, using a process pool when workers > 1 (0 or
+    None means one worker per core). func must be picklable, i.e. a module level
+    function or a functools.partial of one. Returns the list of successful
+    results and a list of (item, error) pairs for the files that failed.
+    '''
+    items = list(items)
+    if not workers:
+        workers = os.cpu_count() or 1
+    workers = min(workers, len(items)) or 1
+    if chunksize is None:
+        #a few chunks per worker keeps the pool balanced without paying IPC per file
+        chunksize = max(1, len(items) // (workers * 4))
+
+    call = partial(_safe_call, func, profile=PROFILER.enabled)
+    results, failures = [], []
+    if workers == 1:
+        outcomes = map(call, items)
+        pool = None
+    else:
+        pool = multiprocessing.Pool(workers, initializer=_init_worker, initargs=(PROFILER.enabled,))
+        outcomes = pool.imap(call, items, chunksize)
+    try:
+        for idx, (item, result, error, metrics) in enumerate(outcomes, 1):
+            if metrics is not None:
+                PROFILER.merge(metrics)
+            if error is None:
+                results.append(result)
+                if verbose and result:
+                    print('[%i/%i] %s' %(idx, len(items), result))
+            else:
+                failures.append((item, error))
+                print('[%i/%i] Failed processing %s: %s' %(idx, len(items),
+                                                           _item_name(item), error))
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
+    if failures:
+        print('%i of %i files could not be processed.' %(len(failures), len(items)))
+    return results, failures
+
+
+'''
+Incremental builds. BuildCache remembers, per stage, which inputs have already
+been processed, keyed on the file's path and the sha1 of its content plus the
+stage parameters, so identical files under different names are tracked apart.
+An input is skipped when its key is known and every output it produced is still
+on disk with the content it had at the end of that run, so outputs rewritten by
+a later stage or by hand count as missing. Outputs are recorded under their own
+content too, so files processed in place are not processed again on the next
+run. File hashes are memoized on size and mtime so unchanged files are not
+re-read.
+'''
+class BuildCache():
+    def __init__(self, path = os.path.join(ROOT, '.pipeline_cache.json')):
+        self.path = path
+        self.hashes = {}
+        self.done = {}
+        self.pending = {}
+        self.recorded = set()
+        self.hits = self.misses = 0
+        if os.path.isfile(path):
+            with open(path) as f:
+                data = json.load(f)
+            self.hashes, self.done = data['hashes'], data['done']
+
+    def digest(self, image_file):
+        image_file = os.path.abspath(image_file)
+        stat = os.stat(image_file)
+        known = self.hashes.get(image_file)
+        if known is not None and known[:2] == [stat.st_size, stat.st_mtime]:
+            return known[2]
+        sha = hashlib.sha1()
+        with open(image_file, 'rb') as f:
+            for block in iter(lambda: f.read(2**20), b''):
+                sha.update(block)
+        self.hashes[image_file] = [stat.st_size, stat.st_mtime, sha.hexdigest()]
+        return sha.hexdigest()
+
+    def key(self, image_file, params):
+        params = json.dumps(params, sort_keys=True)
+        return (os.path.abspath(image_file) + ':' + self.digest(image_file) + ':' +
+                hashlib.sha1(params.encode()).hexdigest())
+
+    def filter(self, items, params, source = None):
+        '''
+        Returns the items that still need processing. params is a dict or a
+        function of the item, source maps an item to the file it is read from.
+        '''
+        todo = []
+        for item in items:
+            itemParams = params(item) if callable(params) else params
+            try:
+                key = self.key(source(item) if source else item, itemParams)
+            except OSError:
+                todo.append(item)
+                continue
+            if self.up_to_date(self.done.get(key)):
+                self.hits += 1
+            else:
+                self.pending[key] = (item, itemParams)
+                todo.append(item)
+        return todo
+
+    def up_to_date(self, outputs):
+        #outputs is a list of [path, sha1] pairs as written by save
+        if not outputs:
+            return False
+        for output in outputs:
+            if not isinstance(output, list) or not os.path.isfile(output[0]):
+                return False
+            if self.digest(output[0]) != output[1]:
+                return False
+        return True
+
+    def record(self, failures, outputs):
+        '''
+        Stores every pending item that is not in failures, with the list of
+        files returned by outputs(item).
+        '''
+        failed = [item for item, _ in failures]
+        for key, (item, itemParams) in self.pending.items():
+            if item in failed:
+                continue
+            produced = [os.path.abspath(w) for w in outputs(item)]
+            self.done[key] = produced
+            self.recorded.add(key)
+            for w in produced:
+                #just written, the memoized hash may predate it
+                self.hashes.pop(w, None)
+                if os.path.isfile(w):
+                    self.done[self.key(w, itemParams)] = produced
+                    self.recorded.add(self.key(w, itemParams))
+            self.misses += 1
+        self.pending = {}
+
+    def save(self):
+        #output hashes are taken now, after every stage of the run has written
+        for key in self.recorded:
+            self.done[key] = [[w, self.digest(w) if os.path.isfile(w) else None]
+                              for w in self.done[key]]
+        self.recorded = set()
+        with open(self.path, 'w') as f:
+            json.dump({'hashes' : self.hashes, 'done' : self.done}, f)
+
+    def report(self):
+        print('Cache: %i files up to date, %i processed.' %(self.hits, self.misses))
+
+
 '''
 We like working with png so we convert every jpg and then delete original jpg
 '''
-def convert_jpg_to_png(folder, outputDir = os.path.join(ROOT, 'tmp'), deleteOriginal=False):
-    for image_file in os.listdir(folder):
+def _converted_name(image_file, outputDir):
+    name = os.path.basename(image_file)
+    if name[-3:] == 'jpg':
+        return [os.path.join(outputDir, name[:-3] + 'png')]
+    elif name[-3:] == 'png':
+        return [os.path.join(outputDir, name)]
+    return []
 
-        if image_file[-3:] == 'jpg':
-            im = Image.open(os.path.join(folder, image_file ))
-            im.save(os.path.join(outputDir, image_file[:-3] + 'png'))
-            if deleteOriginal: os.remove(image_file)
-        elif image_file[-3:] == 'png':
-            copyfile(os.path.join(folder, image_file), os.path.join(outputDir, image_file))
-        else:
-            print("%s is not a valid picture, skipping." %image_file)
+def _convert_file(image_file, outputDir, deleteOriginal=False, encoding='default'):
+    name = os.path.basename(image_file)
+    if name[-3:] == 'jpg':
+        with PROFILER.stage('decode'):
+            im = Image.open(image_file)
+            im.load()
+        if PROFILER.enabled:
+            PROFILER.count_read('decode', os.path.getsize(image_file))
+        save_image(im, os.path.join(outputDir, name[:-3] + 'png'), encoding=encoding)
+        if deleteOriginal: os.remove(image_file)
+        return 'Converted %s.' %name
+    elif name[-3:] == 'png':
+        if os.path.abspath(os.path.dirname(image_file)) != os.path.abspath(outputDir):
+            with PROFILER.stage('copy'):
+                copyfile(image_file, os.path.join(outputDir, name))
+        return None
+    else:
+        return "%s is not a valid picture, skipping." %name
+
+def convert_jpg_to_png(folder, outputDir = os.path.join(ROOT, 'tmp'), deleteOriginal=False, workers=1,
+                       cache=None, encoding='default'):
+    files = [os.path.join(folder, w) for w in sorted(os.listdir(folder))]
+    if cache is not None:
+        files = cache.filter(files, {'stage' : 'convert', 'outputDir' : os.path.abspath(outputDir),
+                                     'encoding' : encoding})
+    _, failures = run_batch(partial(_convert_file, outputDir=outputDir, deleteOriginal=deleteOriginal,
+                                    encoding=encoding),
+                            files, workers=workers)
+    if cache is not None:
+        cache.record(failures, partial(_converted_name, outputDir=outputDir))
     return
 
 
 '''
-Functions to turn image to grayscale and downsample
+Decoding. With a draftSize the image is shrunk while loading: JPEGs are decoded
+directly at a reduced DCT scale and other formats are box-reduced by an integer
+factor. Both stop at REDUCING_GAP times the target so the final resample in
+downsample still has enough pixels to work with.
+'''
+REDUCING_GAP = 2
+
+RESAMPLE_FILTERS = {'nearest' : Image.NEAREST,
+                    'box' : Image.BOX,
+                    'bilinear' : Image.BILINEAR,
+                    'hamming' : Image.HAMMING,
+                    'bicubic' : Image.BICUBIC,
+                    'lanczos' : Image.LANCZOS}
+
+def load_image(image_file, draftSize = None):
+    im = Image.open(image_file)
+    if draftSize is None:
+        return im
+    width, height = draftSize[0] * REDUCING_GAP, draftSize[1] * REDUCING_GAP
+    if im.format == 'JPEG':
+        im.draft(im.mode, (width, height))
+    elif hasattr(im, 'reduce'):
+        factor = min(im.size[0] // width, im.size[1] // height)
+        if factor > 1:
+            im = reducible(im).reduce(factor)
+    return im
+
+def reducible(im):
+    '''
+    Image.reduce rejects palette, 1 bit and 16 bit images. They are converted
+    to the closest mode it accepts, without losing values.
+    '''
+    if im.mode in ('P', 'PA'):
+        return im.convert('RGBA' if im.mode == 'PA' or 'transparency' in im.info else 'RGB')
+    if im.mode == '1':
+        return im.convert('L')
+    if im.mode.startswith('I;16'):
+        return im.convert('I')
+    return im
+
+
+'''
+In-memory transforms. Each one takes a PIL image and returns a new one, so any
+chain of them costs a single decode and a single encode per file.
+'''
+def to_grayscale(im):
+    return im.convert('LA')
+
+def downsample(im, pixelWidth = 50, resample = 'bicubic'):
+    return im.resize((pixelWidth, pixelWidth), RESAMPLE_FILTERS[resample])
+
+def darkpad(im, size = 120, inputSize = None):
+    '''
+    Centers the image on a black size x size canvas. If inputSize is given,
+    images of any other size are rejected.
+    '''
+    if inputSize is not None and im.size != (inputSize, inputSize):
+        raise ValueError('input image is not %ix%i' %(inputSize, inputSize))
+    if im.size[0] > size or im.size[1] > size:
+        raise ValueError('input image is larger than %ix%i' %(size, size))
+    back = Image.new(size = (size,size), mode='RGB')
+    back.paste(im, ((size - im.size[0]) // 2, (size - im.size[1]) // 2))
+    return back
+
+
+def list_images(folder, extensions = ('png', 'jpg', 'webp')):
+    return sorted(os.path.join(folder, w) for w in os.listdir(folder)
+                  if w.rsplit('.', 1)[-1] in extensions and os.path.isfile(os.path.join(folder, w)))
+
+
+class Pipeline():
+    '''
+    Ordered chain of in-memory transforms. Every file is decoded once, pushed
+    through all the steps and only the steps that were given an outputDir are
+    encoded and written (as png, keeping the input's base name). Instances are
+    picklable so they can be handed straight to run_batch. draftSize is the
+    smallest size any step needs, see load_image.
+    '''
+    def __init__(self, draftSize = None, encoding = 'default'):
+        self.steps = []
+        self.draftSize = draftSize
+        self.encoding = encoding
+
+    def add(self, transform, outputDir = None, **params):
+        if params:
+            transform = partial(transform, **params)
+        self.steps.append((transform, outputDir))
+        return self
+
+    def __call__(self, image_file):
+        name = output_name(os.path.basename(image_file), self.encoding)
+        with PROFILER.stage('decode'):
+            im = load_image(image_file, draftSize=self.draftSize)
+            im.load()
+        if PROFILER.enabled:
+            PROFILER.count_read('decode', os.path.getsize(image_file))
+        for transform, outputDir in self.steps:
+            with PROFILER.stage(getattr(transform, 'func', transform).__name__):
+                im = transform(im)
+            if outputDir is not None:
+                save_image(im, os.path.join(outputDir, name), encoding=self.encoding)
+        return 'Finished processing %s.' %name
+
+    def outputs(self, image_file):
+        name = output_name(os.path.basename(image_file), self.encoding)
+        return [os.path.join(outputDir, name) for _, outputDir in self.steps if outputDir is not None]
+
+    def signature(self):
+        '''
+        Description of every step and its parameters, used as the BuildCache key.
+        '''
+        steps = []
+        for transform, outputDir in self.steps:
+            steps.append([getattr(transform, 'func', transform).__name__,
+                          getattr(transform, 'keywords', {}),
+                          outputDir and os.path.abspath(outputDir)])
+        return {'stage' : 'pipeline', 'draftSize' : self.draftSize, 'encoding' : self.encoding,
+                'steps' : steps}
+
+    def run(self, files, workers = 1, cache = None):
+        if cache is not None:
+            files = cache.filter(files, self.signature())
+        results, failures = run_batch(self, files, workers=workers)
+        if cache is not None:
+            cache.record(failures, self.outputs)
+        return results, failures
+
+
+'''
+Streaming. For folders too big to list up front, records of (name, image) are
+produced lazily and pulled through the stages. Every stage runs on its own thread
+with a bounded queue in front of the next one, so decoding, transforming and
+encoding overlap while memory stays constant. PIL releases the GIL while it
+decodes, resizes and encodes, which is where the time goes.
 '''
+_DONE = object()
+
+def iter_files(folder, extensions = ('png', 'jpg', 'webp')):
+    with os.scandir(folder) as entries:
+        for entry in entries:
+            if entry.name.rsplit('.', 1)[-1] in extensions and entry.is_file():
+                yield entry.path
 
-def create_50x50(inputDir, pixelWidth = 50):
-    for image_file in glob.glob(inputDir + '/*png'):
-        im = Image.open(image_file)
-        #turn to grayscale
-        im = im.convert('LA')
-        #downsample
-        im = im.resize((pixelWidth, pixelWidth))
-        #save image
-        im.save(image_file)
-        print('Finished processing %s.' %(os.path.basename(image_file)))
+def stream(func, records, queueSize = 64):
+    '''
+    Applies func to every record on a background thread and yields the results
+    in order. Records for which func raises are reported and dropped, as are
+    None results. Errors from records itself are re-raised to the consumer.
+    '''
+    results = queue.Queue(queueSize)
+    stop = threading.Event()
+
+    def put(item):
+        while not stop.is_set():
+            try:
+                results.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def produce():
+        try:
+            for record in records:
+                try:
+                    result = func(record)
+                except Exception as e:
+                    name = record[0] if isinstance(record, tuple) else record
+                    print('Failed processing %s: %s: %s' %(os.path.basename(str(name)),
+                                                          type(e).__name__, e))
+                    continue
+                if result is not None and not put(result):
+                    return
+        except Exception as e:
+            put((_DONE, e))
+            return
+        put((_DONE, None))
+
+    thread = threading.Thread(target=produce, daemon=True)
+    thread.start()
+    try:
+        while True:
+            item = results.get()
+            if isinstance(item, tuple) and item[0] is _DONE:
+                if item[1] is not None:
+                    raise item[1]
+                return
+            yield item
+    finally:
+        stop.set()
+
+def _decode_record(image_file, draftSize = None, encoding = 'default'):
+    with PROFILER.stage('decode'):
+        im = load_image(image_file, draftSize=draftSize)
+        im.load()
+    if PROFILER.enabled:
+        PROFILER.count_read('decode', os.path.getsize(image_file))
+    return output_name(os.path.basename(image_file), encoding), im
+
+def _transform_record(record, transform, outputDir = None, encoding = 'default'):
+    name, im = record
+    with PROFILER.stage(getattr(transform, 'func', transform).__name__):
+        im = transform(im)
+    if outputDir is not None:
+        save_image(im, os.path.join(outputDir, name), encoding=encoding)
+    return name, im
+
+def stream_images(files, pipeline = None, queueSize = 64):
+    '''
+    Lazily yields (name, image) for every file in files (any iterable, e.g.
+    iter_files(folder)) after the steps of pipeline, each step on its own
+    thread. Steps with an outputDir also write their result, as in Pipeline.
+    '''
+    if pipeline is None:
+        pipeline = Pipeline()
+    records = stream(partial(_decode_record, draftSize=pipeline.draftSize, encoding=pipeline.encoding),
+                     files, queueSize)
+    for transform, outputDir in pipeline.steps:
+        records = stream(partial(_transform_record, transform=transform, outputDir=outputDir,
+                                 encoding=pipeline.encoding),
+                         records, queueSize)
+    return records
+
+
+'''
+Functions to turn image to grayscale and downsample
+'''
+def create_50x50(inputDir, pixelWidth = 50, workers=1, resample='bicubic'):
+    pipeline = Pipeline(draftSize=(pixelWidth, pixelWidth))\
+                         .add(to_grayscale)\
+                         .add(downsample, outputDir=inputDir, pixelWidth=pixelWidth,
+                              resample=resample)
+    pipeline.run(list_images(inputDir, extensions=('png',)), workers=workers)
     return
 
 
@@ -46,20 +478,451 @@ def create_50x50(inputDir, pixelWidth = 50):
 Functions to add dark padding to make 120x120. Only works with pictures that are
 50x50
 '''
-def create_120x120_darkpad(inputDir, outputDir = ROOT + '/cropped/proccesed_imgPad/'):
+def create_120x120_darkpad(inputDir, outputDir = ROOT + '/cropped/proccesed_imgPad/', workers=1):
     assert(os.path.isdir(outputDir))
-    for image_file in glob.glob(inputDir + '/*png'):
-        im = Image.open(image_file)
-        back = Image.new(size = (120,120), mode='RGB')
-        if im.size == (50,50):
-            back.paste(im, (35,35))
-            back.save(outputDir + os.path.basename(image_file))
-            print('Adding dark padding to %s.' %(os.path.basename(image_file)))
-        else:
-            print("input image %s is not 50x50. Skipping." %(os.path.basename(image_file)))
+    pipeline = Pipeline().add(darkpad, outputDir=outputDir, size=120, inputSize=50)
+    pipeline.run(list_images(inputDir, extensions=('png',)), workers=workers)
     return
 
 
+'''
+Packed datasets. Instead of one small png per image, the processed images can be
+stored as a single contiguous uint8 array of shape N x H x W together with the
+file names and labels (the file name without its trailing number, e.g. apple012
+-> apple), so the training side can np.load or memory-map everything at once.
+'''
+def _decode_gray(image_file, pixelWidth = 50, resample = 'bicubic'):
+    with PROFILER.stage('decode'):
+        im = load_image(image_file, draftSize=(pixelWidth, pixelWidth))
+        im.load()
+    if PROFILER.enabled:
+        PROFILER.count_read('decode', os.path.getsize(image_file))
+    #gray scale before resizing, like Pipeline, so pixels match the png outputs
+    with PROFILER.stage('downsample'):
+        im = im.convert('L').resize((pixelWidth, pixelWidth), RESAMPLE_FILTERS[resample])
+    return os.path.basename(image_file), np.asarray(im)
+
+def batch_darkpad(images, size = 120):
+    n, height, width = images.shape
+    top, left = (size - height) // 2, (size - width) // 2
+    padded = np.zeros((n, size, size), dtype=np.uint8)
+    padded[:, top:top + height, left:left + width] = images
+    return padded
+
+def label_from_name(name):
+    return os.path.splitext(name)[0].rstrip('0123456789')
+
+def pack_images(files, pixelWidth = 50, padSize = None, resample = 'bicubic',
+                workers = 1, batchSize = 1024):
+    '''
+    Decodes every file, converts it to gray scale and resizes it, then pads in
+    batches of batchSize images. Returns images, names and labels arrays.
+    '''
+    decoded, _ = run_batch(partial(_decode_gray, pixelWidth=pixelWidth, resample=resample),
+                           files, workers=workers, verbose=False)
+    size = padSize or pixelWidth
+    images = np.empty((len(decoded), size, size), dtype=np.uint8)
+    for start in range(0, len(decoded), batchSize):
+        gray = np.stack([arr for _, arr in decoded[start:start + batchSize]])
+        with PROFILER.stage('batch_darkpad'):
+            images[start:start + len(gray)] = batch_darkpad(gray, padSize) if padSize else gray
+    names = np.array([name for name, _ in decoded])
+    labels = np.array([label_from_name(name) for name in names])
+    return images, names, labels
+
+def save_packed(path, images, names, labels):
+    '''
+    .npz keeps everything in one file. Any other path is written as a plain .npy
+    (which np.load can memory-map) with a <name>_index.csv next to it.
+    '''
+    if path.endswith('.npz'):
+        np.savez(path, images=images, names=names, labels=labels)
+        return
+    if not path.endswith('.npy'):
+        path += '.npy'
+    np.save(path, images)
+    with open(path[:-4] + '_index.csv', 'w') as f:
+        f.write('index,name,label\n')
+        for idx, (name, label) in enumerate(zip(names, labels)):
+            f.write('%i,%s,%s\n' %(idx, name, label))
+
+def load_packed(path, mmap = True):
+    if path.endswith('.npz'):
+        data = np.load(path)
+        return data['images'], data['names'], data['labels']
+    images = np.load(path, mmap_mode='r' if mmap else None)
+    index = np.loadtxt(path[:-4] + '_index.csv', dtype=str, delimiter=',',
+                       skiprows=1, usecols=(1, 2), ndmin=2)
+    return images, index[:, 0], index[:, 1]
+
+
+'''
+Multi-resolution outputs. A level is a size, optionally centered on a dark
+canvas of padSize. Pyramid decodes each crop once, turns it to gray scale and
+makes every level from the smallest one already made that is still
+REDUCING_GAP times its size, largest first, so 128, 64 and 32 cost one full
+resize and two small ones.
+'''
+def parse_levels(spec):
+    '''
+    '32,50,50:120' -> [(32, None), (50, None), (50, 120)].
+    '''
+    levels = []
+    for item in spec.split(','):
+        size, _, pad = item.strip().partition(':')
+        if not size.isdigit() or (pad and not pad.isdigit()):
+            raise ValueError('Pyramid levels look like 50 or 50:120, not %s' %item)
+        level = (int(size), int(pad) if pad else None)
+        if level[1] is not None and level[1] < level[0]:
+            raise ValueError('Padding of %s is smaller than the image' %item)
+        levels.append(level)
+    return levels
+
+def level_name(size, padSize = None):
+    return 'proccesed_img%i' %size + ('_pad%i' %padSize if padSize else '')
+
+def shrink(im, size, resample = 'bicubic'):
+    #integer reduction down to REDUCING_GAP x size first, like load_image
+    factor = min(im.size[0] // (size * REDUCING_GAP), im.size[1] // (size * REDUCING_GAP))
+    if factor > 1 and hasattr(im, 'reduce'):
+        im = reducible(im).reduce(factor)
+    return im.resize((size, size), RESAMPLE_FILTERS[resample])
+
+class Pyramid():
+    '''
+    Every level of a crop from a single decode. Each level is written as png
+    (or the encoding's format) to outputDir/proccesed_img<size>[_pad<padSize>],
+    or returned as arrays by arrays() for pack_pyramid. Picklable like Pipeline.
+    '''
+    def __init__(self, levels, outputDir = os.path.join(ROOT, 'cropped'), resample = 'bicubic',
+                 encoding = 'default'):
+        self.levels = levels
+        self.outputDir = outputDir
+        self.resample = resample
+        self.encoding = encoding
+        self.dirs = [os.path.join(outputDir, level_name(*w)) for w in levels]
+
+    def images(self, image_file):
+        sizes = sorted(set(size for size, _ in self.levels), reverse=True)
+        with PROFILER.stage('decode'):
+            im = load_image(image_file, draftSize=(sizes[0], sizes[0]))
+            im.load()
+        if PROFILER.enabled:
+            PROFILER.count_read('decode', os.path.getsize(image_file))
+        made = [to_grayscale(im)]
+        for size in sizes:
+            sources = [w for w in made if min(w.size) >= size * REDUCING_GAP]
+            with PROFILER.stage('shrink'):
+                made.append(shrink(min(sources, key=lambda w: w.size) if sources else made[0],
+                                   size, self.resample))
+        bySize = dict(zip(sizes, made[1:]))
+        for size, padSize in self.levels:
+            if padSize is None:
+                yield bySize[size]
+            else:
+                with PROFILER.stage('darkpad'):
+                    yield darkpad(bySize[size], size=padSize)
+
+    def __call__(self, image_file):
+        name = output_name(os.path.basename(image_file), self.encoding)
+        for outputDir, im in zip(self.dirs, self.images(image_file)):
+            save_image(im, os.path.join(outputDir, name), encoding=self.encoding)
+        return 'Finished processing %s at %i levels.' %(name, len(self.levels))
+
+    def arrays(self, image_file):
+        return os.path.basename(image_file), [np.asarray(w.convert('L')) for w in self.images(image_file)]
+
+    def outputs(self, image_file):
+        name = output_name(os.path.basename(image_file), self.encoding)
+        return [os.path.join(w, name) for w in self.dirs]
+
+    def signature(self):
+        return {'stage' : 'pyramid', 'levels' : self.levels, 'resample' : self.resample,
+                'encoding' : self.encoding, 'dirs' : [os.path.abspath(w) for w in self.dirs]}
+
+    def run(self, files, workers = 1, cache = None):
+        for w in self.dirs:
+            if not os.path.isdir(w):
+                os.makedirs(w)
+        if cache is not None:
+            files = cache.filter(files, self.signature())
+        results, failures = run_batch(self, files, workers=workers)
+        if cache is not None:
+            cache.record(failures, self.outputs)
+        return results, failures
+
+def pack_pyramid(path, files, pyramid, workers = 1):
+    '''
+    One packed array per level, next to path: dataset.npz -> dataset_50.npz,
+    dataset_50_pad120.npz, ... Returns the paths written.
+    '''
+    decoded, _ = run_batch(pyramid.arrays, files, workers=workers, verbose=False)
+    names = np.array([name for name, _ in decoded])
+    labels = np.array([label_from_name(name) for name in names])
+    base, extension = os.path.splitext(path)
+    written = []
+    for idx, (size, padSize) in enumerate(pyramid.levels):
+        side = padSize or size
+        images = np.empty((len(decoded), side, side), dtype=np.uint8)
+        for row, (_, arrays) in enumerate(decoded):
+            images[row] = arrays[idx]
+        levelPath = '%s_%i%s%s' %(base, size, '_pad%i' %padSize if padSize else '', extension)
+        save_packed(levelPath, images, names, labels)
+        written.append(levelPath)
+    return written
+
+
+'''
+Near-duplicate detection. Every image gets a 64 bit difference hash: it is
+averaged down to 8 rows of 9 cells and each bit says whether a cell is brighter
+than its right neighbour, so re-encoding, rescaling and small shifts in
+brightness barely change it. Hashes are computed for a whole stack at once and
+compared by hamming distance through near_pairs. DedupIndex keeps them on
+disk, memoized on size and mtime, so only new or modified files are decoded.
+'''
+HASH_ROWS, HASH_COLS = 8, 9
+
+def box_resize(images, rows = HASH_ROWS, cols = HASH_COLS):
+    '''
+    Mean over each cell of a rows x cols grid, for a stack of N x H x W images.
+    '''
+    images = np.asarray(images, dtype=np.float32)
+    rowEdges = np.linspace(0, images.shape[1], rows + 1).astype(int)
+    colEdges = np.linspace(0, images.shape[2], cols + 1).astype(int)
+    sums = np.add.reduceat(np.add.reduceat(images, rowEdges[:-1], axis=1), colEdges[:-1], axis=2)
+    return sums / np.outer(np.diff(rowEdges), np.diff(colEdges))
+
+def dhash(images):
+    '''
+    Difference hashes of a stack of N x H x W grayscale images, as uint64.
+    '''
+    thumbs = box_resize(images)
+    bits = (thumbs[:, :, 1:] > thumbs[:, :, :-1]).reshape(len(thumbs), -1)
+    return np.packbits(bits, axis=1).view('>u8')[:, 0].astype(np.uint64)
+
+def _hash_thumb(image_file):
+    #only the 8x9 grid travels back from the worker
+    im = Image.open(image_file).convert('L')
+    if im.size[0] < HASH_COLS or im.size[1] < HASH_ROWS:
+        im = im.resize((max(im.size[0], HASH_COLS), max(im.size[1], HASH_ROWS)))
+    return image_file, box_resize(np.asarray(im)[None])[0]
+
+POPCOUNT = np.array([bin(w).count('1') for w in range(256)], dtype=np.uint8)
+
+def hamming(a, b):
+    return POPCOUNT[(np.asarray(a, dtype=np.uint64) ^ np.asarray(b, dtype=np.uint64))
+                    .view(np.uint8)].reshape(-1, 8).sum(axis=1)
+
+def near_pairs(hashes, distance = 4, chunks = 3):
+    '''
+    Every pair i < j of hashes at most distance bits apart, with its distance.
+    Multi-index hashing: the 64 bits are split into chunks pieces, and two
+    hashes within distance differ by at most distance // chunks bits on at least
+    one piece. So for each piece, every hash looks up the hashes whose piece is
+    that close to its own in a table of hashes sorted by piece, and only those
+    candidates are compared in full, instead of all n^2 pairs.
+    '''
+    hashes = np.asarray(hashes, dtype=np.uint64)
+    n = len(hashes)
+    widths = [64 // chunks + (idx < 64 % chunks) for idx in range(chunks)]
+    found = [np.zeros(0, dtype=np.int64)]
+    shift = 0
+    for width in widths:
+        piece = ((hashes >> np.uint64(shift)) & np.uint64((1 << width) - 1)).astype(np.int64)
+        shift += width
+        order = np.argsort(piece, kind='mergesort')
+        #hashes with piece value v are order[bucket[v]:bucket[v + 1]]
+        bucket = np.concatenate([[0], np.cumsum(np.bincount(piece, minlength=1 << width))])
+        for r in range(distance // chunks + 1):
+            for bits in itertools.combinations(range(width), r):
+                probe = piece ^ sum(1 << b for b in bits)
+                lo = bucket[probe]
+                counts = bucket[probe + 1] - lo
+                hit = np.nonzero(counts)[0]
+                counts = counts[hit]
+                #expand every hit to the positions lo .. lo + count - 1 in order
+                starts = np.repeat(lo[hit] - np.cumsum(counts) + counts, counts)
+                other = order[starts + np.arange(counts.sum())]
+                mine = np.repeat(hit, counts)
+                keep = mine < other
+                found.append(mine[keep] * n + other[keep])
+    found = np.unique(np.concatenate(found))
+    pairs = np.stack([found // n, found % n], axis=1)
+    dists = hamming(hashes[pairs[:, 0]], hashes[pairs[:, 1]])
+    keep = dists <= distance
+    return pairs[keep], dists[keep]
+
+def find_duplicates(names, hashes, distance = 4):
+    '''
+    Goes through names in order and keeps every one whose hash is more than
+    distance bits away from all those kept before it. Returns the others as
+    (duplicate, kept, distance), paired with the closest kept name.
+    '''
+    #identical hashes are looked up once, which also keeps blank images cheap
+    unique, inverse = np.unique(np.asarray(hashes, dtype=np.uint64), return_inverse=True)
+    pairs, dists = near_pairs(unique, distance)
+    neighbours = {}
+    for a, b, dist in zip(pairs[:, 0].tolist(), pairs[:, 1].tolist(), dists.tolist()):
+        neighbours.setdefault(a, []).append((b, dist))
+        neighbours.setdefault(b, []).append((a, dist))
+    keptAs, duplicates = {}, []
+    for idx, u in enumerate(inverse.tolist()):
+        if u in keptAs:
+            duplicates.append((names[idx], names[keptAs[u]], 0))
+            continue
+        match = min([(dist, keptAs[v]) for v, dist in neighbours.get(u, []) if v in keptAs],
+                    default=None)
+        if match is None:
+            keptAs[u] = idx
+        else:
+            duplicates.append((names[idx], names[match[1]], match[0]))
+    return duplicates
+
+class DedupIndex():
+    def __init__(self, path = os.path.join(ROOT, '.dedup_index.json')):
+        self.path = path
+        self.hashes = {}
+        if path and os.path.isfile(path):
+            with open(path) as f:
+                self.hashes = json.load(f)
+
+    def update(self, files, workers = 1):
+        '''
+        Returns {file : hash} for every file that could be read, decoding only
+        the files whose size or mtime changed since they were last hashed.
+        '''
+        hashes, todo = {}, []
+        for image_file in files:
+            stat = os.stat(image_file)
+            known = self.hashes.get(os.path.abspath(image_file))
+            if known is not None and known[:2] == [stat.st_size, stat.st_mtime]:
+                hashes[image_file] = int(known[2], 16)
+            else:
+                todo.append(image_file)
+        results, _ = run_batch(_hash_thumb, todo, workers=workers, verbose=False)
+        if results:
+            for (image_file, _), h in zip(results, dhash([w for _, w in results])):
+                stat = os.stat(image_file)
+                self.hashes[os.path.abspath(image_file)] = [stat.st_size, stat.st_mtime, '%016x' %h]
+                hashes[image_file] = int(h)
+        return hashes
+
+    def forget(self, image_file):
+        self.hashes.pop(os.path.abspath(image_file), None)
+
+    def save(self):
+        #entries of files that are gone would only grow the index
+        self.hashes = {w : v for w, v in self.hashes.items() if os.path.isfile(w)}
+        with open(self.path, 'w') as f:
+            json.dump(self.hashes, f)
+
+def deduplicate(files, distance = 4, drop = False, index = None, workers = 1, outputs = None):
+    '''
+    Flags near-duplicates among files, the first file in sorted order of each
+    group is kept. With drop, the duplicates are deleted, or if outputs is
+    given only the files in outputs(file), e.g. the images made from a crop.
+    Returns the (duplicate, kept, distance) triples.
+    '''
+    index = index if index is not None else DedupIndex(path='')
+    hashes = index.update(files, workers=workers)
+    names = sorted(hashes)
+    duplicates = find_duplicates(names, [hashes[w] for w in names], distance)
+    for duplicate, kept, dist in duplicates:
+        print('%s is a near duplicate of %s (%i bits apart)%s' %(os.path.basename(duplicate),
+              os.path.basename(kept), dist, ', removed.' if drop else '.'))
+        if drop:
+            for w in (outputs(duplicate) if outputs else [duplicate]):
+                if os.path.isfile(w):
+                    os.remove(w)
+            index.forget(duplicate)
+    print('Found %i near duplicates among %i images.' %(len(duplicates), len(names)))
+    return duplicates
+
+def read_dropped(path):
+    '''
+    Names of the crops dropped as duplicates, one per line. The crops stay on
+    disk and later runs leave them out; delete a line to bring one back.
+    '''
+    if not os.path.isfile(path):
+        return set()
+    with open(path) as f:
+        return set(line.strip() for line in f if line.strip())
+
+def record_dropped(path, names):
+    with open(path, 'a') as f:
+        f.write(''.join(w + '\n' for w in names))
+
+
+'''
+Replaying crops. ImageCropper records every crop it saves as one json line with
+the source file, the box in image coordinates, the output name and the dpi.
+replay_manifest re-applies those crops without opening a window. Sources that
+no longer exist (e.g. the tmp/ copies) are looked up by name in inputDir.
+'''
+def read_manifest(path):
+    with open(path) as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+def find_source(source, inputDir):
+    if os.path.isfile(source):
+        return source
+    stem = os.path.splitext(os.path.basename(source))[0]
+    for ext in ('png', 'jpg'):
+        candidate = os.path.join(inputDir, stem + '.' + ext)
+        if os.path.isfile(candidate):
+            return candidate
+    raise IOError('source %s not found in %s' %(os.path.basename(source), inputDir))
+
+def _replay_output(entry, outputDir, encoding = 'default'):
+    #like the cropper, a non default profile decides the extension
+    output = entry['output'] if encoding == 'default' else output_name(entry['output'], encoding)
+    return os.path.join(outputDir, output)
+
+def _replay_source(job, inputDir, outputDir, encoding = 'default'):
+    #all crops of one source share a single decode
+    source, entries = job
+    source = find_source(source, inputDir)
+    with PROFILER.stage('decode'):
+        im = Image.open(source)
+        im.load()
+    if PROFILER.enabled:
+        PROFILER.count_read('decode', os.path.getsize(source))
+    for entry in entries:
+        left, upper, right, lower = entry['box']
+        with PROFILER.stage('crop'):
+            crop = im.crop((max(0, left), max(0, upper), min(im.size[0], right), min(im.size[1], lower)))
+        save_image(crop, _replay_output(entry, outputDir, encoding), encoding = encoding,
+                   dpi = (entry['resolution'], entry['resolution']))
+    return 'Cropped %s into %s.' %(os.path.basename(source),
+                                   ', '.join(os.path.basename(_replay_output(w, outputDir, encoding))
+                                             for w in entries))
+
+def replay_manifest(manifest, inputDir, outputDir, workers = 1, cache = None, encoding = 'default',
+                    processing = None):
+    '''
+    processing describes whatever later rewrites the crops in place (see the
+    downsampling Pipeline in __main__). It is part of the cache key, so changing
+    e.g. pixelWidth cuts the crops again instead of reusing processed ones.
+    '''
+    jobs = {}
+    for entry in read_manifest(manifest):
+        jobs.setdefault(entry['source'], []).append(entry)
+    jobs = list(jobs.items())
+    outputs = lambda job: [_replay_output(w, outputDir, encoding) for w in job[1]]
+    if cache is not None:
+        jobs = cache.filter(jobs, lambda job: {'stage' : 'replay', 'entries' : job[1],
+                                                'outputDir' : os.path.abspath(outputDir),
+                                                'encoding' : encoding,
+                                                'processing' : processing},
+                            source = lambda job: find_source(job[0], inputDir))
+    results, failures = run_batch(partial(_replay_source, inputDir=inputDir, outputDir=outputDir,
+                                          encoding=encoding),
+                                  jobs, workers=workers)
+    if cache is not None:
+        cache.record(failures, outputs)
+    return results, failures
+
+
 if __name__ == '__main__':
     parser = argparse.ArgumentParser(description='Pablo Image Pipeline.')
     parser.add_argument('--inputDir', type=str, default = '.',
@@ -78,8 +941,31 @@ if __name__ == '__main__':
                         help = 'Directory where processed padded images should go.')
     parser.add_argument('--pixelWidth', type=int, default = 50,
                         help = 'Resolution of output image, default is 50x50')
+    parser.add_argument('--resample', type=str, default = 'bicubic',
+                        help = 'Filter used to downsample: %s.' %', '.join(sorted(RESAMPLE_FILTERS)))
     parser.add_argument('--addDarkPad', type=str, default = 'No',
                         help = 'Should be "Yes" if we want to add dark padding.')
+    parser.add_argument('--pyramid', type=str, default = '',
+                        help = 'Sizes to make from each crop in one pass, e.g. 32,50,64,128,50:120 '
+                               '(size:padSize), instead of pixelWidth and addDarkPad.')
+    parser.add_argument('--packedArray', type=str, default = '',
+                        help = 'Save processed images as one .npy/.npz array instead of png files.')
+    parser.add_argument('--manifest', type=str, default = '',
+                        help = 'Where crops are recorded, default is crop_manifest.jsonl in outputDir.')
+    parser.add_argument('--replay', type=str, default = '',
+                        help = 'Re-apply the crops in this manifest without opening a window.')
+    parser.add_argument('--dedup', type=str, default = '',
+                        help = 'Look for near-duplicate images after processing: flag or drop.')
+    parser.add_argument('--dedupDistance', type=int, default = 4,
+                        help = 'Hashes at most this many bits apart (out of 64) are duplicates.')
+    parser.add_argument('--workers', type=int, default = 1,
+                        help = 'Number of processes for the batch stages, 0 uses every core.')
+    parser.add_argument('--encoding', type=str, default = 'default',
+                        help = 'How output images are encoded: %s.' %', '.join(available_profiles()))
+    parser.add_argument('--noCache', action='store_true',
+                        help = 'Reprocess every file instead of skipping unchanged ones.')
+    parser.add_argument('--profile', type=str, default = '',
+                        help = 'Time every stage, print a summary and save it with a trace to this json file.')
     args = parser.parse_args()
 
     if not os.path.isdir(args.inputDir) or not os.listdir(args.inputDir):
@@ -88,55 +974,187 @@ if __name__ == '__main__':
     if not os.path.isdir(args.outputDir):
         print("Output directory not valid! EXITING")
         sys.exit(0)
-    if not args.outputPrefix:
+    if args.replay and not os.path.isfile(args.replay):
+        print("Manifest to replay not found! EXITING")
+        sys.exit(0)
+    if not args.outputPrefix and not args.replay:
         print("You must specify output prefix! EXITING")
         sys.exit(0)
     if args.extension not in ['jpg','png']:
         print('Extension must be png or jpg only! EXITING')
         sys.exit(0)
+    if args.resample not in RESAMPLE_FILTERS:
+        print('Resample filter must be one of %s! EXITING' %', '.join(sorted(RESAMPLE_FILTERS)))
+        sys.exit(0)
+    if args.encoding not in available_profiles():
+        print('Encoding must be one of %s! EXITING' %', '.join(available_profiles()))
+        sys.exit(0)
+    if args.encoding != 'default' and args.extension != 'png':
+        print('Only the default encoding can write jpg crops! EXITING')
+        sys.exit(0)
+    if args.workers < 0:
+        print('Number of workers cannot be negative! EXITING')
+        sys.exit(0)
     if not os.path.isdir(args.imgPadDir):
         print("Directory for padded images not valid! EXITING")
         sys.exit(0)
+    if args.dedup not in ['', 'flag', 'drop']:
+        print('Dedup must be flag or drop! EXITING')
+        sys.exit(0)
+    if args.pyramid:
+        try:
+            levels = parse_levels(args.pyramid)
+        except ValueError as e:
+            print('%s! EXITING' %e)
+            sys.exit(0)
+        if args.dedup and args.packedArray:
+            print('Dedup only works on pyramid files, not packed arrays! EXITING')
+            sys.exit(0)
 
 
-    tmp_dir = os.path.join(ROOT, 'tmp')
-    if os.path.isdir(tmp_dir):
-        rmtree(tmp_dir)
-    os.mkdir(tmp_dir)
+    if args.profile:
+        PROFILER.enable()
 
+    #skip files that are unchanged since the last run with the same settings
+    cache = None if args.noCache else BuildCache()
+
+    if args.replay:
+        #headless: re-apply recorded crops, no window is opened
+        #without a pyramid or packed array the crops are downsampled in place below
+        inPlace = None if args.pyramid or args.packedArray else \
+                  {'pixelWidth' : args.pixelWidth, 'resample' : args.resample}
+        replay_manifest(args.replay, args.inputDir, args.outputDir, workers = args.workers,
+                        cache = cache, encoding = args.encoding, processing = inPlace)
+        tmp_dir = None
+    else:
+        tmp_dir = os.path.join(ROOT, 'tmp')
+        if cache is None:
+            if os.path.isdir(tmp_dir):
+                rmtree(tmp_dir)
+            os.mkdir(tmp_dir)
+        else:
+            #tmp is kept between runs, only drop files that don't come from this input
+            if not os.path.isdir(tmp_dir):
+                os.mkdir(tmp_dir)
+            expected = set()
+            for w in os.listdir(args.inputDir):
+                expected.update(_converted_name(w, tmp_dir))
+            for w in os.listdir(tmp_dir):
+                if os.path.join(tmp_dir, w) not in expected:
+                    os.remove(os.path.join(tmp_dir, w))
 
-    #convert input pictures from jpg to png and save to tmp folder
-    convert_jpg_to_png(args.inputDir, outputDir = tmp_dir, deleteOriginal=False)
+        #convert input pictures from jpg to png and save to tmp folder
+        #tmp is scratch space, so favour speed over size
+        convert_jpg_to_png(args.inputDir, outputDir = tmp_dir, deleteOriginal=False,
+                           workers = args.workers, cache = cache, encoding = 'fast')
 
-    #Instructions for cropping
-    print('''
+        #Instructions for cropping
+        print('''
             Use the left ard right arrows to change image.
 
             Click and drag a box to crop.
 
             Close window to exit.''')
 
-    input('\npress Enter to begin')
+        input('\npress Enter to begin')
 
-    #define cropper
-    IC = ImageCropper(infile_folder = tmp_dir,
-                      infile_prefix = args.inputPrefix,
-                      outfile_folder = args.outputDir,
-                      outfile_prefix = args.outputPrefix,
-                      outfile_extension = args.extension,
-                      resolution = args.resolution)
-    #Run cropping tool
-    IC.mainloop()
+        #define cropper, pygame is only loaded on this interactive path
+        from ImageCropper import ImageCropper
+        IC = ImageCropper(infile_folder = tmp_dir,
+                          infile_prefix = args.inputPrefix,
+                          outfile_folder = args.outputDir,
+                          outfile_prefix = args.outputPrefix,
+                          outfile_extension = args.extension,
+                          resolution = args.resolution,
+                          encoding = args.encoding,
+                          manifest = args.manifest or os.path.join(args.outputDir,
+                                                                   'crop_manifest.jsonl'))
+        #Run cropping tool
+        IC.mainloop()
 
-    #convert output of cropping to png in case it's not converted
-    convert_jpg_to_png(args.outputDir)
+    #crops dropped as duplicates by an earlier run are left out of every stage
+    droppedFile = os.path.join(args.outputDir, 'dropped_duplicates.txt')
+    dropped = read_dropped(droppedFile)
+    crops = [w for w in list_images(args.outputDir) if os.path.basename(w) not in dropped]
 
-    #turning to gray scale and downsampling to 50 by 50
-    create_50x50(args.outputDir, pixelWidth = args.pixelWidth)
+    #images to look for duplicates in, what to delete for each and the crop it came from
+    processed = None
+    if args.pyramid:
+        #every level from a single decode of each crop, the crops are left as they are
+        pyramid = Pyramid(levels, outputDir = args.outputDir, resample = args.resample,
+                          encoding = args.encoding)
+        if args.packedArray:
+            for path in pack_pyramid(args.packedArray, crops, pyramid,
+                                     workers = args.workers):
+                print('Saved %s.' %path)
+        else:
+            pyramid.run(crops, workers=args.workers, cache=cache)
+            #the smallest level is the cheapest to hash
+            smallest = min(range(len(levels)), key=lambda w: (levels[w][0], levels[w][1] or 0))
+            byLevel = {os.path.basename(pyramid.outputs(w)[0]) : w for w in crops}
+            levelFiles = [w for w in list_images(pyramid.dirs[smallest])
+                          if os.path.basename(w) in byLevel]
+            processed = (levelFiles,
+                         lambda w: pyramid.outputs(byLevel[os.path.basename(w)]),
+                         lambda w: byLevel[os.path.basename(w)])
+    elif args.packedArray:
+        #one array for the whole dataset, padded to 120x120 if requested
+        images, names, labels = pack_images(crops,
+                                            pixelWidth = args.pixelWidth,
+                                            padSize = 120 if args.addDarkPad == 'Yes' else None,
+                                            resample = args.resample,
+                                            workers = args.workers)
+        if args.dedup:
+            #hash the crops themselves, not the padding around them
+            off = (images.shape[1] - args.pixelWidth) // 2
+            hashes = dhash(images[:, off:off + args.pixelWidth, off:off + args.pixelWidth])
+            duplicates = find_duplicates(names, hashes, args.dedupDistance)
+            for duplicate, kept, dist in duplicates:
+                print('%s is a near duplicate of %s (%i bits apart)%s' %(duplicate, kept, dist,
+                      ', left out.' if args.dedup == 'drop' else '.'))
+            print('Found %i near duplicates among %i images.' %(len(duplicates), len(names)))
+            if args.dedup == 'drop':
+                keep = ~np.isin(names, [w[0] for w in duplicates])
+                images, names, labels = images[keep], names[keep], labels[keep]
+        save_packed(args.packedArray, images, names, labels)
+        print('Saved %i images of size %ix%i to %s.' %(images.shape + (args.packedArray,)))
+    else:
+        #single pass over the crops: decode, turn to gray scale, downsample to
+        #pixelWidth and optionally add dark padding, writing the final images only
+        processing = Pipeline(draftSize=(args.pixelWidth, args.pixelWidth), encoding=args.encoding)\
+                               .add(to_grayscale)\
+                               .add(downsample, outputDir=args.outputDir, pixelWidth=args.pixelWidth,
+                                    resample=args.resample)
+        #adding dark padding for use in neural code setup
+        if args.addDarkPad == 'Yes':
+            processing.add(darkpad, outputDir=os.path.join(ROOT, args.imgPadDir), size=120)
+        processing.run(crops, workers=args.workers, cache=cache)
+        #the crops were downsampled in place, dropping one only removes its padded copy
+        processed = (crops,
+                     lambda w: [o for o in processing.outputs(w)
+                                if os.path.abspath(o) != os.path.abspath(w)],
+                     lambda w: w)
+
+    if args.dedup and processed is not None:
+        #hashes of unchanged files are kept between runs, like the build cache
+        dedupIndex = DedupIndex() if cache is not None else None
+        duplicates = deduplicate(processed[0], distance = args.dedupDistance,
+                                 drop = args.dedup == 'drop', index = dedupIndex,
+                                 workers = args.workers, outputs = processed[1])
+        if args.dedup == 'drop' and duplicates:
+            record_dropped(droppedFile, [os.path.basename(processed[2](w)) for w, _, _ in duplicates])
+            print('Dropped crops are listed in %s and left out from now on.' %droppedFile)
+        if dedupIndex is not None:
+            dedupIndex.save()
 
-    #adding dark padding for use in neural code setup
-    if args.addDarkPad == 'Yes':
-        create_120x120_darkpad(args.outputDir, outputDir = os.path.join(ROOT, args.imgPadDir))
+    if cache is not None:
+        cache.save()
+        cache.report()
+    #delete tmp dir, unless it is kept for the next run
+    elif tmp_dir is not None:
+        rmtree(tmp_dir)
 
-    #delete tmp dir
-    rmtree(tmp_dir)
+    if args.profile:
+        PROFILER.print_summary()
+        PROFILER.write(args.profile)
+        print('Profile written to %s, the traceEvents load in chrome://tracing.' %args.profile)
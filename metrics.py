@@ -0,0 +1,139 @@
+import os
+import json
+import time
+import threading
+import contextlib
+import numpy as np
+
+'''
+Opt-in instrumentation for the pipeline stages and the cropper save path.
+
+PROFILER.stage('name') times a block, count_read/count_written add bytes and
+file counts; encoding.save_image records the encode and write stages. While the
+profiler is disabled stage() hands back a shared no-op context and the counters
+return straight away, so instrumented code costs an attribute check. Worker
+processes drain what they recorded with snapshot() and the parent folds it in
+with merge(), see image_pipeline.run_batch.
+'''
+#histogram bucket upper edges, in milliseconds
+BUCKETS_MS = [0.1, 0.25, 0.5, 1, 2.5, 5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000]
+
+class _NullStage():
+    def __enter__(self):
+        return None
+
+    def __exit__(self, *exc):
+        return False
+
+_NULL = _NullStage()
+
+class Profiler():
+    def __init__(self):
+        self.enabled = False
+        self.lock = threading.Lock()
+        self.origin = time.perf_counter()
+        self.reset()
+
+    def reset(self):
+        self.timings = {}
+        self.bytesRead = {}
+        self.bytesWritten = {}
+        self.files = {}
+        self.events = []
+
+    def enable(self):
+        self.enabled = True
+
+    def stage(self, name):
+        if not self.enabled:
+            return _NULL
+        return self._timed(name)
+
+    @contextlib.contextmanager
+    def _timed(self, name):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            end = time.perf_counter()
+            with self.lock:
+                self.timings.setdefault(name, []).append(end - start)
+                self.events.append({'name' : name, 'ph' : 'X',
+                                    'ts' : (start - self.origin) * 1e6,
+                                    'dur' : (end - start) * 1e6,
+                                    'pid' : os.getpid(),
+                                    'tid' : threading.get_ident()})
+
+    def count_read(self, name, nbytes):
+        if not self.enabled:
+            return
+        with self.lock:
+            self.bytesRead[name] = self.bytesRead.get(name, 0) + nbytes
+            self.files[name] = self.files.get(name, 0) + 1
+
+    def count_written(self, name, nbytes):
+        if not self.enabled:
+            return
+        with self.lock:
+            self.bytesWritten[name] = self.bytesWritten.get(name, 0) + nbytes
+            self.files[name] = self.files.get(name, 0) + 1
+
+    def snapshot(self):
+        '''
+        Everything recorded so far, which is then cleared.
+        '''
+        with self.lock:
+            data = {'timings' : self.timings, 'bytesRead' : self.bytesRead,
+                    'bytesWritten' : self.bytesWritten, 'files' : self.files,
+                    'events' : self.events}
+            self.reset()
+        return data
+
+    def merge(self, data):
+        with self.lock:
+            for name, samples in data['timings'].items():
+                self.timings.setdefault(name, []).extend(samples)
+            for field in ['bytesRead', 'bytesWritten', 'files']:
+                counts = getattr(self, field)
+                for name, value in data[field].items():
+                    counts[name] = counts.get(name, 0) + value
+            self.events.extend(data['events'])
+
+    def summary(self):
+        stages = {}
+        for name in sorted(set(self.timings) | set(self.files)):
+            samples = np.asarray(self.timings.get(name, [0.])) * 1000
+            counts = np.histogram(samples, bins=[0] + BUCKETS_MS + [np.inf])[0]
+            stages[name] = {'calls' : len(self.timings.get(name, [])),
+                            'total_s' : float(samples.sum()) / 1000,
+                            'mean_ms' : float(samples.mean()),
+                            'p50_ms' : float(np.percentile(samples, 50)),
+                            'p90_ms' : float(np.percentile(samples, 90)),
+                            'p99_ms' : float(np.percentile(samples, 99)),
+                            'max_ms' : float(samples.max()),
+                            'histogram_ms' : dict(zip([str(w) for w in BUCKETS_MS] + ['inf'],
+                                                      [int(w) for w in counts])),
+                            'files' : self.files.get(name, 0),
+                            'bytes_read' : self.bytesRead.get(name, 0),
+                            'bytes_written' : self.bytesWritten.get(name, 0)}
+        return stages
+
+    def print_summary(self):
+        print('%-14s %7s %9s %9s %9s %9s %7s %10s %10s' %('stage', 'calls', 'total_s', 'mean_ms',
+              'p90_ms', 'max_ms', 'files', 'MB read', 'MB written'))
+        for name, r in self.summary().items():
+            print('%-14s %7i %9.2f %9.2f %9.2f %9.2f %7i %10.1f %10.1f' %(name, r['calls'],
+                  r['total_s'], r['mean_ms'], r['p90_ms'], r['max_ms'], r['files'],
+                  r['bytes_read'] / 1e6, r['bytes_written'] / 1e6))
+
+    def write(self, path):
+        '''
+        Summary plus every timed block in trace-event format, which loads in
+        chrome://tracing or Perfetto.
+        '''
+        with open(path, 'w') as f:
+            json.dump({'summary' : self.summary(), 'traceEvents' : self.events,
+                       'displayTimeUnit' : 'ms'}, f)
+
+PROFILER = Profiler()
+
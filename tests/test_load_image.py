@@ -0,0 +1,53 @@
+import os
+import sys
+import io
+import contextlib
+import numpy as np
+from PIL import Image
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import image_pipeline as ip
+
+'''
+load_image shrinks large pngs with Image.reduce, which rejects some modes.
+Each odd mode file is processed next to an RGB copy and must give the same
+pixels, give or take rounding for 16 bit, which is reduced at full depth.
+'''
+def odd_images(folder):
+    rng = np.random.RandomState(0)
+    rgb = Image.fromarray(rng.randint(0, 256, size=(400, 400, 3)).astype(np.uint8))
+    images = {'palette' : rgb.quantize(64),
+              'bilevel' : rgb.convert('1'),
+              'sixteen' : Image.fromarray(rng.randint(0, 256, size=(400, 400)).astype(np.uint16))}
+    for name, im in images.items():
+        im.save(os.path.join(folder, name + '.png'))
+        im.convert('RGB').save(os.path.join(folder, name + '_rgb.png'))
+    return sorted(images)
+
+def gray(path):
+    return np.asarray(Image.open(path).convert('L'), dtype=int)
+
+def same(a, b, name):
+    return np.abs(a - b).max() <= (1 if name == 'sixteen' else 0)
+
+def test_load_image_odd_modes(tmp_path):
+    for name in odd_images(str(tmp_path)):
+        im = ip.load_image(str(tmp_path / (name + '.png')), draftSize=(50, 50))
+        assert im.size == (100, 100)
+
+def test_pipeline_stages_odd_modes(tmp_path):
+    names = odd_images(str(tmp_path))
+    files = ip.list_images(str(tmp_path))
+    with contextlib.redirect_stdout(io.StringIO()):
+        images, packedNames, _ = ip.pack_images(files)
+        ip.Pyramid([(32, None)], outputDir=str(tmp_path)).run(files)
+        _, failures = ip.Pipeline(draftSize=(50, 50)).add(ip.to_grayscale)\
+                        .add(ip.downsample, outputDir=str(tmp_path)).run(files)
+    assert failures == []
+    packed = dict(zip(packedNames, images))
+    for name in names:
+        assert gray(str(tmp_path / (name + '.png'))).shape == (50, 50)
+        assert same(gray(str(tmp_path / (name + '.png'))), gray(str(tmp_path / (name + '_rgb.png'))), name)
+        assert same(packed[name + '.png'].astype(int), packed[name + '_rgb.png'].astype(int), name)
+        level = tmp_path / 'proccesed_img32'
+        assert same(gray(str(level / (name + '.png'))), gray(str(level / (name + '_rgb.png'))), name)
@@ -0,0 +1,76 @@
+import os
+import sys
+import json
+import shutil
+import subprocess
+import numpy as np
+from PIL import Image
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+'''
+Replays a manifest through the command line twice with the build cache on.
+The scripts are copied to a temporary folder so the cache file lands there.
+'''
+def setup_run(tmp):
+    for name in ['image_pipeline.py', 'metrics.py', 'encoding.py']:
+        shutil.copy(os.path.join(ROOT, name), str(tmp))
+    for folder in ['pics', 'cropped', 'pad']:
+        os.mkdir(str(tmp / folder))
+    rng = np.random.RandomState(0)
+    entries = []
+    for idx in range(3):
+        pixels = rng.randint(0, 256, size=(240, 320, 3)).astype(np.uint8)
+        Image.fromarray(pixels).save(str(tmp / 'pics' / ('apple%03i.jpg' %idx)))
+        entries.append({'source' : 'gone/apple%03i.png' %idx, 'box' : [10, 10, 210, 210],
+                        'output' : 'apple%03i.png' %idx, 'resolution' : 300})
+    with open(str(tmp / 'manifest.jsonl'), 'w') as f:
+        f.write(''.join(json.dumps(w) + '\n' for w in entries))
+
+def replay(tmp, *extra):
+    cmd = [sys.executable, 'image_pipeline.py', '--inputDir', 'pics', '--outputDir', 'cropped',
+           '--imgPadDir', 'pad', '--replay', 'manifest.jsonl'] + list(extra)
+    return subprocess.run(cmd, cwd=str(tmp), check=True, stdout=subprocess.PIPE,
+                          universal_newlines=True).stdout
+
+def sizes(tmp):
+    folder = str(tmp / 'cropped')
+    return set(Image.open(os.path.join(folder, w)).size for w in os.listdir(folder)
+               if w.endswith('.png'))
+
+def test_replay_again_with_other_pixel_width(tmp_path):
+    setup_run(tmp_path)
+    replay(tmp_path)
+    assert sizes(tmp_path) == {(50, 50)}
+    out = replay(tmp_path)
+    assert 'Cropped' not in out
+    assert sizes(tmp_path) == {(50, 50)}
+    out = replay(tmp_path, '--pixelWidth', '32')
+    #crops are cut again, not downsampled from the 50x50 images
+    assert out.count('Cropped') == 3
+    assert sizes(tmp_path) == {(32, 32)}
+    out = replay(tmp_path)
+    assert out.count('Cropped') == 3
+    assert sizes(tmp_path) == {(50, 50)}
+
+def test_dropped_duplicates_stay_dropped(tmp_path):
+    setup_run(tmp_path)
+    with open(str(tmp_path / 'manifest.jsonl'), 'a') as f:
+        f.write(json.dumps({'source' : 'gone/apple000.png', 'box' : [10, 10, 210, 210],
+                            'output' : 'copy000.png', 'resolution' : 300}) + '\n')
+    for extra in [[], ['--pyramid', '32,50:120']]:
+        for w in ['cropped', 'pad']:
+            shutil.rmtree(str(tmp_path / w))
+            os.mkdir(str(tmp_path / w))
+        out = replay(tmp_path, '--dedup', 'drop', *extra)
+        assert 'copy000.png is a near duplicate of apple000.png' in out
+        #the crop stays on disk and is listed, every output made from it is gone
+        assert os.path.isfile(str(tmp_path / 'cropped' / 'copy000.png'))
+        with open(str(tmp_path / 'cropped' / 'dropped_duplicates.txt')) as f:
+            assert f.read().split() == ['copy000.png']
+        for root, _, files in os.walk(str(tmp_path / 'cropped')):
+            assert root == str(tmp_path / 'cropped') or 'copy000.png' not in files
+        assert not os.path.isfile(str(tmp_path / 'pad' / 'copy000.png'))
+        out = replay(tmp_path, '--dedup', 'drop', *extra)
+        assert 'Cropped' not in out
+        assert ' 0 processed' in out